@@ -0,0 +1,239 @@
+#! /usr/bin/env python3
+
+import hashlib
+import json
+import os
+import shutil
+from functools import wraps
+from os import path
+from time import time
+
+from luigi import Task
+from luigi.task import flatten
+
+
+def file_digest(filepath, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+class ArtifactStore:
+    """
+    Persistent, content-addressed store of task outputs.
+
+    Each artifact is a directory named after its key, holding a copy of every
+    output file and a `meta.json`. The directory's modification time records
+    when it was last used: once the store grows beyond `max_bytes`, the least
+    recently used artifacts are removed. Artifacts older than `max_age` are
+    never restored.
+
+    :param root: Directory of the store.
+    :param max_bytes: Size the store is trimmed down to after each `put`.
+    :param max_age: Time-to-live of an artifact, in seconds.
+    """
+
+    def __init__(self, root, max_bytes, max_age):
+        os.makedirs(root, exist_ok=True)
+
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+    @classmethod
+    def from_config(cls):
+        from configs import cache_cfg
+
+        cfg = cache_cfg()
+
+        return cls(path.join(path.expanduser(cfg.path), 'artifacts'),
+                   cfg.artifact_max_mb * 1024 * 1024,
+                   cfg.artifact_ttl * 24 * 60 * 60)
+
+    def artifact_path(self, key):
+        return path.join(self.root, key)
+
+    def get(self, key, filepaths):
+        """
+        Copy the files of artifact `key` to `filepaths`, in order.
+
+        :return: Whether the artifact was found and restored.
+        """
+
+        directory = self.artifact_path(key)
+
+        try:
+            with open(path.join(directory, 'meta.json')) as f:
+                meta = json.load(f)
+
+            if (meta['created'] < time() - self.max_age
+                    or meta['files'] != len(filepaths)):
+                return False
+
+            for i, filepath in enumerate(filepaths):
+                os.makedirs(path.dirname(filepath), exist_ok=True)
+                temp_path = '{}.restore-{}'.format(filepath, os.getpid())
+                shutil.copyfile(path.join(directory, str(i)), temp_path)
+                os.replace(temp_path, filepath)
+
+            os.utime(directory)
+        except (FileNotFoundError, ValueError, KeyError):
+            # missing, half-evicted or unreadable artifacts are misses
+            return False
+
+        return True
+
+    def put(self, key, filepaths, description=''):
+        """
+        Store a copy of `filepaths` as artifact `key`, then evict the least
+        recently used artifacts if the store has grown too large.
+        """
+        from tempfile import mkdtemp
+
+        temp_dir = mkdtemp(dir=self.root, prefix='.' + key[:16] + '.')
+
+        try:
+            for i, filepath in enumerate(filepaths):
+                shutil.copyfile(filepath, path.join(temp_dir, str(i)))
+
+            with open(path.join(temp_dir, 'meta.json'), 'w') as f:
+                json.dump({'description': description,
+                           'created': time(),
+                           'files': len(filepaths),
+                           }, f)
+
+            directory = self.artifact_path(key)
+            shutil.rmtree(directory, ignore_errors=True)
+
+            try:
+                os.replace(temp_dir, directory)
+            except OSError:
+                # another worker stored the same artifact in the meantime
+                pass
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+        self.evict()
+
+    def size(self, directory):
+        return sum(entry.stat().st_size for entry in os.scandir(directory))
+
+    def evict(self):
+        artifacts = []
+
+        for entry in os.scandir(self.root):
+            if entry.is_dir() and not entry.name.startswith('.'):
+                try:
+                    artifacts.append((entry.stat().st_mtime,
+                                      self.size(entry.path),
+                                      entry.path))
+                except FileNotFoundError:
+                    continue
+
+        total = sum(size for _, size, _ in artifacts)
+
+        for _, size, directory in sorted(artifacts):
+            if total <= self.max_bytes:
+                break
+
+            shutil.rmtree(directory, ignore_errors=True)
+            total -= size
+
+
+def stored(run):
+    """
+    Wrap a `run` method of an `ArtifactTask` so it restores the outputs from
+    the artifact store when possible, and stores them after a successful run.
+    """
+
+    @wraps(run)
+    def wrapper(self):
+        if self.restore_artifact():
+            return
+
+        run(self)
+        self.store_artifact()
+
+    return wrapper
+
+
+class ArtifactTask(Task):
+    """
+    A Task whose outputs are kept in the `ArtifactStore`, keyed by a hash of
+    the Task's family, significant parameters, `artifact_version` and the
+    contents of its `artifact_inputs()`.
+
+    The Task is complete when its outputs exist, or when an artifact with the
+    same key exists and can be restored, so unchanged stages are skipped
+    across runs. Subclasses write their `run` as usual: it's wrapped to
+    restore or store the artifact.
+
+    Increase `artifact_version` whenever `run` changes what it writes.
+    """
+
+    artifact_version = 1
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+        if 'run' in cls.__dict__:
+            cls.run = stored(cls.__dict__['run'])
+
+    def artifact_inputs(self):
+        """
+        The targets the outputs are derived from. Override to narrow them
+        down, e.g. to the ids a lookup is made for.
+        """
+
+        return self.input()
+
+    def artifact_key(self):
+        """
+        Return the key of the artifact, or `None` if an input is missing.
+        """
+
+        digest = hashlib.sha256()
+        digest.update(json.dumps([self.task_family,
+                                  self.to_str_params(only_significant=True),
+                                  self.artifact_version,
+                                  ], sort_keys=True).encode())
+
+        for target in flatten(self.artifact_inputs()):
+            if not target.exists():
+                return None
+
+            digest.update(file_digest(target.path).encode())
+
+        return digest.hexdigest()
+
+    def output_paths(self):
+        return [target.path for target in flatten(self.output())]
+
+    def restore_artifact(self):
+        key = self.artifact_key()
+
+        if key is None:
+            return False
+
+        restored = ArtifactStore.from_config().get(key, self.output_paths())
+
+        if restored:
+            print('Restored {} from artifact {}'.format(self.task_family,
+                                                        key[:12]))
+
+        return restored
+
+    def store_artifact(self):
+        key = self.artifact_key()
+
+        if key is not None:
+            ArtifactStore.from_config().put(key,
+                                            self.output_paths(),
+                                            self.task_id)
+
+    def complete(self):
+        return super().complete() or self.restore_artifact()
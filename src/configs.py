@@ -2,6 +2,7 @@
 
 from luigi import Config
 from luigi.parameter import ParameterVisibility, IntParameter, Parameter
+from luigi.parameter import BoolParameter, FloatParameter, DictParameter
 
 
 class sendgrid(Config):
@@ -29,3 +30,99 @@ class postgres_cfg_music(Config):
                           significant=False)
     read_password = Parameter(visibility=ParameterVisibility.PRIVATE,
                               significant=False)
+
+
+class spotify_cfg(Config):
+    api_url = Parameter(default='https://api.spotify.com/v1',
+                        description='Base URL of the Spotify Web API')
+    parallel_pages = BoolParameter(default=False,
+                                   description='Fetch the pages of offset '
+                                               'paginated endpoints '
+                                               'concurrently')
+    page_workers = IntParameter(default=8,
+                                description='Maximum number of pages fetched '
+                                            'at the same time')
+    batch_workers = IntParameter(default=8,
+                                 description='Maximum number of id batch '
+                                             'lookups in flight at once')
+    playlist_workers = IntParameter(default=4,
+                                    description='Maximum number of playlists '
+                                                'fetched at the same time')
+    pool_size = IntParameter(default=10,
+                             description='Number of keep-alive connections '
+                                         'kept open to the Spotify API')
+    requests_per_second = FloatParameter(default=10.0,
+                                         description='Sustained request rate '
+                                                     'allowed per process')
+    burst = IntParameter(default=10,
+                         description='Number of requests that may be sent '
+                                     'back to back before rate limiting')
+    max_retries = IntParameter(default=5,
+                               description='Retries for throttled or failed '
+                                           'requests before giving up')
+    backoff_base = FloatParameter(default=1.0,
+                                  description='Initial backoff, in seconds')
+    backoff_cap = FloatParameter(default=60.0,
+                                 description='Maximum backoff, in seconds')
+    timeout = FloatParameter(default=30.0,
+                             description='Seconds to wait for a connection '
+                                         'or a response before retrying')
+
+
+class cache_cfg(Config):
+    path = Parameter(default='~/.cache/spotify-playlist-creator',
+                     description='Directory for data kept between runs')
+    album_ttl = IntParameter(default=30,
+                             description='Days before a cached album is '
+                                         'fetched again')
+    artist_ttl = IntParameter(default=7,
+                              description='Days before a cached artist is '
+                                          'fetched again')
+    audio_features_ttl = IntParameter(default=365,
+                                      description='Days before cached audio '
+                                                  'features are fetched again')
+    artifact_ttl = IntParameter(default=7,
+                                description='Days before a stored task '
+                                            'output is no longer reused')
+    artifact_max_mb = IntParameter(default=1024,
+                                   description='Size the artifact store is '
+                                               'trimmed down to, in MB')
+
+
+class instrumentation_cfg(Config):
+    enabled = BoolParameter(default=True,
+                            description='Write a report line for every task '
+                                        'run')
+    report_dir = Parameter(default='~/.cache/spotify-playlist-creator/'
+                                   'reports',
+                           description='Directory of the JSON-lines run '
+                                       'reports, one file per run')
+    prometheus_path = Parameter(default='',
+                                description='If set, the run report is also '
+                                            'written to this Prometheus '
+                                            'textfile after every task')
+
+
+class mood_cfg(Config):
+    clusters = IntParameter(default=12,
+                            description='Number of mood clusters')
+    batch_size = IntParameter(default=1024,
+                              description='Tracks per mini-batch k-means '
+                                          'step')
+    iterations = IntParameter(default=200,
+                              description='Mini-batch steps per fit')
+    seed = IntParameter(default=0,
+                        description='Random seed, so refits are repeatable')
+    playlists = DictParameter(default={},
+                              description='Playlist id to sync each cluster '
+                                          'to, e.g. {"0": "37i9dQZF1..."}; '
+                                          'clusters left out aren\'t synced')
+
+
+class genre_scoring_cfg(Config):
+    smoothing = FloatParameter(default=0.5,
+                               description='Weight of the genres that often '
+                                           'occur with a track\'s own genres')
+    top_k = IntParameter(default=3,
+                         description='Number of playlists suggested per '
+                                     'unsorted track')
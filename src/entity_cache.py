@@ -0,0 +1,114 @@
+#! /usr/bin/env python3
+
+import json
+import sqlite3
+from collections import Counter
+from os import makedirs, path
+from time import time
+
+
+class EntityCache:
+    """
+    Persistent cache of raw API objects, keyed by entity type and Spotify id.
+
+    Objects are stored as JSON in a SQLite database and are considered stale
+    once they are older than the TTL for their entity type. `stats` counts
+    hits and misses per entity type.
+
+    :param filepath: Location of the SQLite database.
+    :param ttls: Dictionary of entity type to time-to-live, in seconds.
+    """
+
+    def __init__(self, filepath, ttls):
+        makedirs(path.dirname(filepath), exist_ok=True)
+
+        self.ttls = ttls
+        self.stats = Counter()
+        self.connection = sqlite3.connect(filepath, timeout=60)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS entities(
+                                   entity_type TEXT NOT NULL,
+                                   id TEXT NOT NULL,
+                                   fetched_at REAL NOT NULL,
+                                   data TEXT NOT NULL,
+                                   PRIMARY KEY (entity_type, id));""")
+
+    @classmethod
+    def from_config(cls):
+        from configs import cache_cfg
+
+        cfg = cache_cfg()
+        filepath = path.join(path.expanduser(cfg.path), 'entities.sqlite')
+        day = 24 * 60 * 60
+        ttls = {'albums': cfg.album_ttl * day,
+                'artists': cfg.artist_ttl * day,
+                'audio_features': cfg.audio_features_ttl * day,
+                }
+
+        return cls(filepath, ttls)
+
+    def get_many(self, entity_type, ids):
+        """
+        Return a dictionary of id to object for every id with a fresh entry.
+        """
+        from more_itertools import chunked
+
+        oldest = time() - self.ttls[entity_type]
+        found = {}
+
+        # stay below SQLite's limit on the number of bound variables
+        for group in chunked(ids, 500):
+            sql = """SELECT id, data FROM entities
+                     WHERE entity_type = ?
+                       AND fetched_at >= ?
+                       AND id IN ({});""".format(', '.join('?' * len(group)))
+
+            rows = self.connection.execute(sql,
+                                           [entity_type, oldest, *group])
+            found.update((id_, json.loads(data)) for id_, data in rows)
+
+        self.stats[entity_type + '_hits'] += len(found)
+        self.stats[entity_type + '_misses'] += len(ids) - len(found)
+
+        return found
+
+    def put_many(self, entity_type, objects):
+        fetched_at = time()
+        rows = ((entity_type, obj['id'], fetched_at, json.dumps(obj))
+                for obj in objects)
+
+        with self.connection:
+            self.connection.executemany("""INSERT OR REPLACE INTO entities
+                                           VALUES (?, ?, ?, ?);""", rows)
+
+    def close(self):
+        self.connection.close()
+
+
+def cached_lookup(entity_type, ids, fetch):
+    """
+    Return the objects for `ids`, only calling `fetch` for the ids that aren't
+    in the cache (or whose entries have expired).
+
+    :param entity_type: The cache namespace, e.g. `albums`.
+    :param ids: Iterable of Spotify ids.
+    :param fetch: Callable taking a list of ids and returning their objects.
+                  Ids the API has no object for may come back as `None`.
+    :return: Tuple of (objects in the order of `ids`, cache `stats`). Ids
+             without an object are left out.
+    """
+
+    cache = EntityCache.from_config()
+    ids = list(dict.fromkeys(ids))
+
+    try:
+        found = cache.get_many(entity_type, ids)
+        missing = [id_ for id_ in ids if id_ not in found]
+
+        if missing:
+            fetched = [obj for obj in fetch(missing) if obj is not None]
+            cache.put_many(entity_type, fetched)
+            found.update((obj['id'], obj) for obj in fetched)
+    finally:
+        cache.close()
+
+    return [found[id_] for id_ in ids if id_ in found], cache.stats
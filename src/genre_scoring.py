@@ -0,0 +1,209 @@
+#! /usr/bin/env python3
+
+import numpy as np
+from luigi.util import requires
+from get_audio_features import GetSavedTracks
+from get_audio_features import ExplodeGenresArtists, ExplodeGenresAlbums
+from get_playlists import GetTracksByPlaylist
+from artifact_store import ArtifactTask
+from intermediates import arrow_target, sparse_target
+from intermediates import read_frame, read_sparse, write_frame, write_sparse
+
+
+def plain_index(values):
+    """
+    Return an Index of the distinct `values` in order of appearance, as plain
+    objects even when `values` is categorical, so that positions in it match
+    the order of its labels.
+    """
+    from pandas import Index, unique
+
+    return Index(np.asarray(unique(values), dtype=object))
+
+
+def codes(values, index):
+    """
+    Return the position of each of `values` in `index`, or -1 for values that
+    aren't in it.
+    """
+
+    return index.get_indexer(np.asarray(values, dtype=object))
+
+
+def incidence(rows, cols, row_index, col_index):
+    """
+    Build a sparse `len(row_index)` × `len(col_index)` matrix counting the
+    (row, col) pairs of an edge list. Pairs with a value outside the indexes
+    are left out.
+    """
+    from scipy import sparse
+
+    row_codes = codes(rows, row_index)
+    col_codes = codes(cols, col_index)
+    keep = (row_codes >= 0) & (col_codes >= 0)
+
+    return sparse.csr_matrix((np.ones(keep.sum(), dtype='float32'),
+                              (row_codes[keep], col_codes[keep])),
+                             shape=(len(row_index), len(col_index)))
+
+
+def normalize_rows(matrix):
+    """
+    Scale every row of a sparse matrix to unit length; empty rows stay empty.
+    """
+    from scipy import sparse
+
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    scale = np.divide(1, norms, out=np.zeros_like(norms), where=norms > 0)
+
+    return (sparse.diags(scale) @ matrix).tocsr()
+
+
+@requires(GetSavedTracks, ExplodeGenresArtists, ExplodeGenresAlbums)
+class TrackGenreMatrix(ArtifactTask):
+    """
+    Build the sparse track × genre matrix of the saved tracks, and the genre
+    × genre co-occurrence matrix.
+
+    A track gets the genres of each of its artists and of its album, counted
+    once per source. Ids and genre names are dictionary-encoded into row and
+    column positions, listed in the `tracks` and `genres` outputs, so all
+    joins are sparse matrix products instead of merges on strings. Entry
+    (i, j) of the co-occurrence matrix is the number of tracks having both
+    genres i and j; the diagonal is the number of tracks per genre.
+    """
+
+    def output(self):
+        return {'track_genres': sparse_target('track_genres'),
+                'genre_cooccurrence': sparse_target('genre_cooccurrence'),
+                'tracks': arrow_target('track_genre_tracks'),
+                'genres': arrow_target('track_genre_genres'),
+                }
+
+    def artifact_inputs(self):
+        return [self.input()[0][0], self.input()[1], self.input()[2]]
+
+    def run(self):
+        from pandas import DataFrame, Index
+
+        songs = read_frame(self.input()[0][0],
+                           columns=['id', 'album_id', 'artist_ids'])
+        artist_genres = read_frame(self.input()[1])
+        album_genres = read_frame(self.input()[2])
+
+        track_index = plain_index(songs['id'])
+        artist_index = plain_index(artist_genres['artist_id'])
+        album_index = plain_index(album_genres['album_id'])
+        genre_index = Index(sorted(set(artist_genres['genre_name'])
+                                   | set(album_genres['genre_name'])),
+                            dtype=object)
+
+        track_artists = songs[['id', 'artist_ids']].explode('artist_ids')
+
+        track_genres = (incidence(track_artists['id'],
+                                  track_artists['artist_ids'],
+                                  track_index,
+                                  artist_index)
+                        @ incidence(artist_genres['artist_id'],
+                                    artist_genres['genre_name'],
+                                    artist_index,
+                                    genre_index)
+                        + incidence(songs['id'],
+                                    songs['album_id'],
+                                    track_index,
+                                    album_index)
+                        @ incidence(album_genres['album_id'],
+                                    album_genres['genre_name'],
+                                    album_index,
+                                    genre_index))
+
+        has_genre = (track_genres > 0).astype('float32')
+        cooccurrence = has_genre.T @ has_genre
+
+        write_sparse(track_genres, self.output()['track_genres'])
+        write_sparse(cooccurrence, self.output()['genre_cooccurrence'])
+        write_frame(DataFrame({'track_id': track_index}),
+                    self.output()['tracks'])
+        write_frame(DataFrame({'genre_name': genre_index}),
+                    self.output()['genres'])
+
+
+@requires(TrackGenreMatrix, GetTracksByPlaylist)
+class ScoreGenrePlaylists(ArtifactTask):
+    """
+    Rank our genre playlists for every saved track that isn't in any of them.
+
+    Each track's genre vector is expanded with the genres that co-occur with
+    its own, weighted by `genre_scoring_cfg.smoothing` and by how often they
+    co-occur, so a `shoegaze` track still matches a playlist of `dream pop`.
+    A playlist's profile is the sum of the genre vectors of its tracks, and a
+    track's score for a playlist is the cosine similarity of the two. Only
+    playlist tracks among the saved tracks have known genres, so the
+    profiles are best after a full, non-incremental run.
+
+    The output lists the `genre_scoring_cfg.top_k` best playlists of each
+    unsorted track that has any genre.
+    """
+
+    artifact_version = 2
+
+    def output(self):
+        return arrow_target('genre_playlist_scores')
+
+    def run(self):
+        from scipy import sparse
+        from pandas import DataFrame
+        from configs import genre_scoring_cfg
+
+        cfg = genre_scoring_cfg()
+        matrices = self.input()[0]
+
+        track_genres = read_sparse(matrices['track_genres'])
+        cooccurrence = read_sparse(matrices['genre_cooccurrence'])
+        track_index = plain_index(read_frame(matrices['tracks'])['track_id'])
+
+        memberships = read_frame(self.input()[1])
+        playlist_index = plain_index(memberships['genre_name'])
+        in_playlist = incidence(memberships['track_id'],
+                                memberships['genre_name'],
+                                track_index,
+                                playlist_index)
+
+        # P(genre j | genre i), leaving out each genre itself
+        frequency = cooccurrence.diagonal()
+        inverse = np.divide(1, frequency,
+                            out=np.zeros_like(frequency),
+                            where=frequency > 0)
+        related = (sparse.diags(inverse) @ cooccurrence).tolil()
+        related.setdiag(0)
+        related = related.tocsr()
+
+        vectors = normalize_rows(track_genres)
+        vectors = normalize_rows(vectors + cfg.smoothing * vectors @ related)
+        profiles = normalize_rows(in_playlist.T @ vectors)
+
+        unsorted = np.flatnonzero((in_playlist.getnnz(axis=1) == 0)
+                                  & (vectors.getnnz(axis=1) > 0))
+        scores = (vectors[unsorted] @ profiles.T).toarray()
+
+        k = min(cfg.top_k, len(playlist_index))
+
+        if k == 0 or len(unsorted) == 0:
+            best = np.empty((len(unsorted), 0), dtype='int64')
+        else:
+            best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            order = np.argsort(-np.take_along_axis(scores, best, axis=1),
+                               axis=1)
+            best = np.take_along_axis(best, order, axis=1)
+
+        best_scores = np.take_along_axis(scores, best, axis=1)
+        found = (best_scores > 0).ravel()
+
+        ranked = DataFrame({
+            'track_id': np.repeat(track_index[unsorted], best.shape[1]),
+            'genre_name': playlist_index[best.ravel()],
+            'score': best_scores.ravel(),
+            'rank': np.tile(np.arange(1, best.shape[1] + 1), len(unsorted)),
+        })
+
+        write_frame(ranked[found], self.output())
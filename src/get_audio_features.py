@@ -1,115 +1,193 @@
 #! /usr/bin/env python3
 
 from luigi import Task, LocalTarget
-from luigi.format import Nop
+from luigi.parameter import BoolParameter
 from luigi.util import requires, inherits
-from postgres_templates import TransactionFactTable, CopyWrapper, HashableDict
-from spotify_api import check_for_refresh
+from postgres_templates import TransactionFactTable, UpsertDimensionTable
+from postgres_templates import CopyWrapper, HashableDict
+from spotify_client import api_url, get_by_ids, get_pages, iter_pages
+from sync_state import commit_state, load_state
+from entity_cache import cached_lookup
+from intermediates import arrow_target, read_frame
+from intermediates import record_writer, write_frame
+from artifact_store import ArtifactTask
+
+
+def saved_track_schema():
+    import pyarrow as pa
+
+    return pa.schema([('id', pa.string()),
+                      ('name', pa.string()),
+                      ('main_artist', pa.string()),
+                      ('available_in_us', pa.bool_()),
+                      ('duration_ms', pa.int64()),
+                      ('explicit', pa.bool_()),
+                      ('uri', pa.string()),
+                      ('preview_url', pa.string()),
+                      ('album_id', pa.string()),
+                      ('artist_ids', pa.list_(pa.string())),
+                      ('added_at', pa.string()),
+                      ])
+
+
+def project_saved_track(song):
+    """
+    Keep only the fields of a saved track object that the pipeline uses.
+    """
+
+    track = song['track']
+
+    return {'id': track['id'],
+            'name': track['name'],
+            'main_artist': track['artists'][0]['id'],
+            'available_in_us': 'US' in track['available_markets'],
+            'duration_ms': track['duration_ms'],
+            'explicit': track['explicit'],
+            'uri': track['uri'],
+            'preview_url': track['preview_url'],
+            'album_id': track['album']['id'],
+            'artist_ids': [artist['id'] for artist in track['artists']],
+            'added_at': song['added_at'],
+            }
+
+
+def is_seen(song, watermark):
+    """
+    Whether a saved track is at or below the `watermark` of the last load.
+    """
+
+    if watermark is None:
+        return False
+
+    return (song['added_at'] < watermark['added_at']
+            or (song['added_at'] == watermark['added_at']
+                and song['id'] in watermark['ids']))
+
+
+def get_watermark(songs, previous=None):
+    """
+    Return the high-water mark of `songs` and the `previous` one: the latest
+    `added_at` and the ids of the tracks saved at that time.
+    """
+
+    if not songs:
+        return previous
+
+    added_at = max(song['added_at'] for song in songs)
+    ids = [song['id'] for song in songs if song['added_at'] == added_at]
+
+    if previous is not None:
+        if previous['added_at'] > added_at:
+            return previous
+        elif previous['added_at'] == added_at:
+            ids = previous['ids'] + ids
+
+    return {'added_at': added_at, 'ids': ids}
 
 
 class GetSavedTracks(Task):
+    """
+    Download the saved tracks of the user.
+
+    Each page is projected to the fields in `saved_track_schema()` as soon as
+    it arrives and appended to the output, so memory use depends on the page
+    size rather than on the size of the library.
+
+    :param incremental: Only download the tracks saved since the last
+                        successful load, by paging newest-first until the
+                        saved high-water mark is reached.
+    """
+
+    incremental = BoolParameter(default=False)
 
     def output(self):
         import os
 
-        file_location = os.path.expanduser('~/Temp/luigi/spotify/{}.pckl')
-        return [LocalTarget(file_location.format('saved_songs'), format=Nop),
-                LocalTarget(file_location.format('mini_albums'), format=Nop),
-                LocalTarget(file_location.format('mini_artists'), format=Nop),
+        return [arrow_target('saved_songs'),
+                arrow_target('mini_albums'),
+                arrow_target('mini_artists'),
+                LocalTarget(os.path.expanduser('~/Temp/luigi/spotify/'
+                                               'saved_tracks_watermark.json')),
                 ]
 
-    def run(self):
-        from requests import get
-        import pickle
+    def new_songs(self, pages, watermark):
+        """
+        Yield the projected songs of each page, stopping at the first song
+        that was already loaded if running incrementally.
+        """
+        from itertools import takewhile
 
-        [x.makedirs() for x in self.output()]
+        for data in pages:
+            songs = [project_saved_track(song) for song in data['items']]
 
-        access_token = check_for_refresh()
+            if not self.incremental:
+                yield songs
+                continue
 
-        headers = {'Authorization': 'Bearer {}'.format(access_token)}
-        url = 'https://api.spotify.com/v1/me/tracks'
-        params = {'limit': 50}
+            # pages are sorted newest first, so stop at the first seen track
+            new_songs = list(takewhile(lambda x: not is_seen(x, watermark),
+                                       songs))
+            yield new_songs
 
-        songs = []
+            if len(new_songs) < len(songs):
+                break
 
-        while url is not None:
-            for attempt in range(2):
-                access_token = check_for_refresh()
-                headers = {'Authorization': 'Bearer {}'.format(access_token)}
+    def run(self):
+        import json
+        from pandas import DataFrame
 
-                r = get(url, params=params, headers=headers)
+        [x.makedirs() for x in self.output()]
 
-                if r.status_code == 200:
-                    break
-            else:  # no break
-                print('Error accessing url: {}'.format(url))
-                r.raise_for_status()
+        url = api_url('me/tracks')
+        params = {'limit': 50}
+        watermark = load_state('saved_tracks_watermark')
 
-            data = r.json()
-            songs.extend(data['items'])
-            url = data['next']
+        if self.incremental:
+            pages = get_pages(url, params)
+        else:
+            pages = iter_pages(url, params)
 
-        albums = set(song['track']['album']['id']
-                     for song in songs)
+        albums = set()
+        artists = set()
+        new_watermark = watermark
 
-        artists = set(artist['id'] for song in songs
-                      for artist in song['track']['artists'])
+        with record_writer(self.output()[0], saved_track_schema()) as write:
+            for songs in self.new_songs(pages, watermark):
+                write(songs)
 
-        with self.output()[0].open('w') as f:
-            pickle.dump(songs, f, protocol=-1)
+                albums.update(song['album_id'] for song in songs)
+                artists.update(artist for song in songs
+                               for artist in song['artist_ids'])
+                new_watermark = get_watermark(songs, new_watermark)
 
-        with self.output()[1].open('w') as f:
-            pickle.dump(albums, f, protocol=-1)
+        write_frame(DataFrame({'id': sorted(albums)}), self.output()[1])
+        write_frame(DataFrame({'id': sorted(artists)}), self.output()[2])
 
-        with self.output()[2].open('w') as f:
-            pickle.dump(artists, f, protocol=-1)
+        with self.output()[3].open('w') as f:
+            json.dump(new_watermark, f)
 
 
 @requires(GetSavedTracks)
-class GetAlbums(Task):
+class GetAlbums(ArtifactTask):
 
     def output(self):
-        import os
+        return arrow_target('full_albums')
 
-        file_location = os.path.expanduser('~/Temp/luigi/spotify/{}.pckl')
-        return LocalTarget(file_location.format('full_albums'), format=Nop)
+    def artifact_inputs(self):
+        return self.input()[1]
 
     def run(self):
-        from requests import get
-        from more_itertools import chunked
         from pandas import DataFrame
-        import pickle
-
-        self.output().makedirs()
-
-        with self.input()[1].open('r') as f:
-            short_albums = pickle.load(f)
 
-        access_token = check_for_refresh()
+        short_albums = read_frame(self.input()[1])['id']
 
-        headers = {'Authorization': 'Bearer {}'.format(access_token)}
-        url = 'https://api.spotify.com/v1/albums'
+        albums, stats = cached_lookup(
+            'albums',
+            short_albums,
+            lambda ids: get_by_ids(api_url('albums'), ids, 20, 'albums'))
 
-        albums = []
-        grouped = chunked(short_albums, 20)
-
-        for group in grouped:
-            params = {'ids': ','.join(album for album in group)}
-
-            for attempt in range(2):
-                access_token = check_for_refresh()
-                headers = {'Authorization': 'Bearer {}'.format(access_token)}
-
-                r = get(url, params=params, headers=headers)
-
-                if r.status_code == 200:
-                    break
-            else:  # no break
-                print('Error accessing url: {}'.format(url))
-                r.raise_for_status()
-
-            data = r.json()
-            albums.extend(data['albums'])
+        print('Album cache: {albums_hits} hits, {albums_misses} misses'
+              .format(**stats))
 
         album_data = [(album['id'],
                        album['name'],
@@ -117,6 +195,7 @@ class GetAlbums(Task):
                        'US' in album['available_markets'],
                        album['album_type'],
                        album['release_date'],
+                       album.get('release_date_precision'),
                        album['label'],
                        album['genres'],
                        [artist['id'] for artist in album['artists']])
@@ -129,258 +208,231 @@ class GetAlbums(Task):
                                          'available_in_us',
                                          'album_type',
                                          'release_date',
+                                         'release_date_precision',
                                          'label',
                                          'genre',
                                          'artist',
                                          ])
 
-        with self.output().temporary_path() as temp_path:
-            full_albums.to_pickle(temp_path, compression=None)
-
+        write_frame(full_albums, self.output())
 
-@requires(GetAlbums)
-class ExplodeArtistsAlbums(Task):
-
-    def output(self):
-        import os
-
-        file_location = os.path.expanduser('~/Temp/luigi/spotify/{}.pckl')
-        return LocalTarget(file_location.format('album_artists'), format=Nop)
-
-    def run(self):
-        import pickle
 
-        self.output().makedirs()
+def parse_release_dates(dates, precision=None):
+    """
+    Split `YYYY`, `YYYY-MM` and `YYYY-MM-DD` release dates into nullable
+    `Int16` year, month and day columns.
 
-        with self.input().open('r') as f:
-            full_albums = pickle.load(f)
+    :param dates: Series of release dates.
+    :param precision: Optional Series of the API's `release_date_precision`
+                      (`year`, `month` or `day`). Parts finer than the
+                      precision are set to missing; where it's missing, the
+                      parts present in the date are used.
+    :return: DataFrame with `release_year`, `release_month` and `release_day`.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    from pandas import DataFrame, Int16Dtype
 
-        album_artists = full_albums[['id', 'artist']]
-        album_artists = album_artists.explode('artist')
-        album_artists.columns = ['album_id', 'artist_id']
+    index = dates.index
+    dates = pa.array(dates, type=pa.string(), from_pandas=True)
 
-        with self.output().temporary_path() as temp_path:
-            album_artists.to_pickle(temp_path, compression=None)
+    def part(start, stop):
+        text = pc.utf8_slice_codeunits(dates, start, stop)
+        digits = pc.match_substring_regex(text, '^[0-9]{%d}$' % (stop - start))
+        values = pc.cast(pc.if_else(digits, text, None), pa.int16())
 
+        return values.to_pandas(types_mapper={pa.int16(): Int16Dtype()}.get)
 
-@requires(GetSavedTracks, ExplodeArtistsAlbums)
-class GetArtists(Task):
+    year = part(0, 4)
+    month = part(5, 7)
+    day = part(8, 10)
 
-    def output(self):
-        import os
+    if precision is not None:
+        unknown = precision.isna().to_numpy()
+        has_month = precision.isin(['month', 'day']).to_numpy()
+        has_day = (precision == 'day').to_numpy()
 
-        file_location = os.path.expanduser('~/Temp/luigi/spotify/{}.pckl')
-        return LocalTarget(file_location.format('full_artists'), format=Nop)
+        month = month.where(unknown | has_month)
+        day = day.where(unknown | has_day)
 
-    def run(self):
-        from requests import get
-        from more_itertools import chunked
-        from pandas import DataFrame, read_pickle
-        import pickle
+    return DataFrame({'release_year': year,
+                      'release_month': month,
+                      'release_day': day,
+                      }).set_axis(index)
 
-        self.output().makedirs()
 
-        with self.input()[0][2].open('r') as f:
-            short_artists = pickle.load(f)
+class FusedOutput(Task):
+    """
+    One output of a fused transform Task, exposed as a Task of its own so
+    that the table jobs and downstream Tasks can keep requiring it.
 
-        with self.input()[1].open('r') as f:
-            artist_x_album = read_pickle(f, compression=None)
+    The output, stored under `output_name`, is written by the required fused
+    Task. Luigi still schedules this Task and runs it once that one is done,
+    but `run` has nothing left to do.
+    """
 
-        access_token = check_for_refresh()
+    output_name = None
 
-        headers = {'Authorization': 'Bearer {}'.format(access_token)}
-        url = 'https://api.spotify.com/v1/artists'
+    def output(self):
+        return self.input()[self.output_name]
 
-        short_artists.update(artist_x_album['artist_id'].values)
+    def run(self):
+        pass
 
-        artists = []
-        grouped = chunked(short_artists, 50)
 
-        for group in grouped:
-            params = {'ids': ','.join(artist for artist in group)}
+@requires(GetAlbums)
+class TransformAlbums(ArtifactTask):
+    """
+    Read the full albums once and write every table derived from them.
+    """
 
-            for attempt in range(2):
-                access_token = check_for_refresh()
-                headers = {'Authorization': 'Bearer {}'.format(access_token)}
+    artifact_version = 2
 
-                r = get(url, params=params, headers=headers)
+    def output(self):
+        return {'album_artists': arrow_target('album_artists'),
+                'album_genres': arrow_target('album_genres'),
+                'clean_albums': arrow_target('clean_albums'),
+                }
 
-                if r.status_code == 200:
-                    break
-            else:  # no break
-                print('Error accessing url: {}'.format(url))
-                r.raise_for_status()
+    def run(self):
+        from pandas import concat
 
-            data = r.json()
-            artists.extend(data['artists'])
+        full_albums = read_frame(self.input())
 
-        artist_data = [(artist['id'],
-                        artist['name'],
-                        artist['uri'],
-                        artist['genres'])
-                       for artist in artists]
+        album_artists = full_albums[['id', 'artist']].explode('artist')
+        album_artists.columns = ['album_id', 'artist_id']
 
-        full_artists = DataFrame(artist_data,
-                                 columns=['id', 'name', 'uri', 'genre'])
+        album_genres = full_albums[['id', 'genre']].explode('genre').dropna()
+        album_genres.columns = ['album_id', 'genre_name']
 
-        with self.output().temporary_path() as temp_path:
-            full_artists.to_pickle(temp_path, compression=None)
+        # the edge lists repeat every id, so store them dictionary-encoded
+        album_artists = album_artists.astype('category')
+        album_genres = album_genres.astype('category')
 
+        clean_albums = full_albums.drop(['genre', 'artist'], axis=1)
+        release_info = parse_release_dates(
+            clean_albums['release_date'],
+            clean_albums['release_date_precision'])
 
-@requires(GetArtists)
-class ExplodeGenresArtists(Task):
+        clean_albums = concat([clean_albums, release_info], axis=1)
 
-    def output(self):
-        import os
+        write_frame(album_artists, self.output()['album_artists'])
+        write_frame(album_genres, self.output()['album_genres'])
+        write_frame(clean_albums, self.output()['clean_albums'])
 
-        file_location = os.path.expanduser('~/Temp/luigi/spotify/{}.pckl')
-        return LocalTarget(file_location.format('artist_genres'), format=Nop)
 
-    def run(self):
-        import pickle
+@requires(TransformAlbums)
+class ExplodeArtistsAlbums(FusedOutput):
+    output_name = 'album_artists'
 
-        self.output().makedirs()
 
-        with self.input().open('r') as f:
-            full_artists = pickle.load(f)
+@requires(TransformAlbums)
+class ExplodeGenresAlbums(FusedOutput):
+    output_name = 'album_genres'
 
-        artist_genres = full_artists[['id', 'genre']]
-        artist_genres = artist_genres.explode('genre')
-        artist_genres.columns = ['artist_id', 'genre_name']
 
-        with self.output().temporary_path() as temp_path:
-            artist_genres.to_pickle(temp_path, compression=None)
+@requires(TransformAlbums)
+class CleanAlbums(FusedOutput):
+    output_name = 'clean_albums'
 
 
-@requires(GetArtists)
-class CleanArtists(Task):
+@requires(GetSavedTracks, ExplodeArtistsAlbums)
+class GetArtists(ArtifactTask):
 
     def output(self):
-        import os
+        return arrow_target('full_artists')
 
-        file_location = os.path.expanduser('~/Temp/luigi/spotify/{}.pckl')
-        return LocalTarget(file_location.format('clean_artists'), format=Nop)
+    def artifact_inputs(self):
+        return [self.input()[0][2], self.input()[1]]
 
     def run(self):
-        import pickle
-
-        self.output().makedirs()
-
-        with self.input().open('r') as f:
-            full_artists = pickle.load(f)
-
-        full_artists.drop(['genre'], axis=1, inplace=True)
-
-        with self.output().temporary_path() as temp_path:
-            full_artists.to_pickle(temp_path, compression=None)
-
+        from pandas import DataFrame
 
-@requires(GetAlbums)
-class ExplodeGenresAlbums(Task):
+        short_artists = set(read_frame(self.input()[0][2])['id'])
 
-    def output(self):
-        import os
+        artist_x_album = read_frame(self.input()[1], columns=['artist_id'])
+        short_artists.update(artist_x_album['artist_id'].values)
 
-        file_location = os.path.expanduser('~/Temp/luigi/spotify/{}.pckl')
-        return LocalTarget(file_location.format('album_genres'), format=Nop)
+        artists, stats = cached_lookup(
+            'artists',
+            short_artists,
+            lambda ids: get_by_ids(api_url('artists'), ids, 50, 'artists'))
 
-    def run(self):
-        import pickle
+        print('Artist cache: {artists_hits} hits, {artists_misses} misses'
+              .format(**stats))
 
-        self.output().makedirs()
+        artist_data = [(artist['id'],
+                        artist['name'],
+                        artist['uri'],
+                        artist['genres'])
+                       for artist in artists]
 
-        with self.input().open('r') as f:
-            full_albums = pickle.load(f)
+        full_artists = DataFrame(artist_data,
+                                 columns=['id', 'name', 'uri', 'genre'])
 
-        album_genres = full_albums[['id', 'genre']]
-        album_genres = album_genres.explode('genre')
-        album_genres.columns = ['album_id', 'genre_name']
+        write_frame(full_artists, self.output())
 
-        with self.output().temporary_path() as temp_path:
-            album_genres.to_pickle(temp_path, compression=None)
 
+@requires(GetArtists)
+class TransformArtists(ArtifactTask):
+    """
+    Read the full artists once and write every table derived from them.
+    """
 
-@requires(GetAlbums)
-class CleanAlbums(Task):
+    artifact_version = 2
 
     def output(self):
-        import os
-
-        file_location = os.path.expanduser('~/Temp/luigi/spotify/{}.pckl')
-        return LocalTarget(file_location.format('clean_albums'), format=Nop)
+        return {'artist_genres': arrow_target('artist_genres'),
+                'clean_artists': arrow_target('clean_artists'),
+                }
 
     def run(self):
-        import pickle
-        from pandas import concat
-
-        self.output().makedirs()
+        full_artists = read_frame(self.input())
 
-        with self.input().open('r') as f:
-            full_albums = pickle.load(f)
+        artist_genres = full_artists[['id', 'genre']].explode('genre')
+        artist_genres = artist_genres.dropna().astype('category')
+        artist_genres.columns = ['artist_id', 'genre_name']
 
-        full_albums.drop(['genre', 'artist'], axis=1, inplace=True)
+        clean_artists = full_artists.drop(['genre'], axis=1)
 
-        regex_pat = (r'^(?P<release_year>\d{4})?-?'
-                     r'(?P<release_month>\d{2})?-?'
-                     r'(?P<release_day>\d{2})?$')
+        write_frame(artist_genres, self.output()['artist_genres'])
+        write_frame(clean_artists, self.output()['clean_artists'])
 
-        release_info = full_albums['release_date'].str.extractall(regex_pat)
-        # release_info = release_info.astype(float).astype('Int64')
-        release_info.fillna('\\N', inplace=True)
 
-        release_info.index = release_info.index.droplevel(1)
+@requires(TransformArtists)
+class ExplodeGenresArtists(FusedOutput):
+    output_name = 'artist_genres'
 
-        clean_albums = concat([full_albums, release_info], axis=1)
 
-        with self.output().temporary_path() as temp_path:
-            clean_albums.to_pickle(temp_path, compression=None)
+@requires(TransformArtists)
+class CleanArtists(FusedOutput):
+    output_name = 'clean_artists'
 
 
 @requires(GetSavedTracks)
-class GetAudioFeatures(Task):
+class GetAudioFeatures(ArtifactTask):
 
     def output(self):
-        import os
+        return arrow_target('audio_features')
 
-        file_location = os.path.expanduser('~/Temp/luigi/spotify/{}.pckl')
-        return LocalTarget(file_location.format('audio_features'), format=Nop)
+    def artifact_inputs(self):
+        return self.input()[0]
 
     def run(self):
-        from requests import get
-        from more_itertools import chunked
         from pandas import DataFrame
-        import pickle
-
-        self.output().makedirs()
-
-        with self.input()[0].open('r') as f:
-            songs = pickle.load(f)
-
-        access_token = check_for_refresh()
 
-        headers = {'Authorization': 'Bearer {}'.format(access_token)}
-        url = 'https://api.spotify.com/v1/audio-features/'
+        songs = read_frame(self.input()[0], columns=['id'])
 
-        audio_features = []
-        grouped = chunked(songs, 100)
+        audio_features, stats = cached_lookup(
+            'audio_features',
+            songs['id'],
+            lambda ids: get_by_ids(api_url('audio-features'),
+                                   ids,
+                                   100,
+                                   'audio_features'))
 
-        for group in grouped:
-            params = {'ids': ','.join(song['track']['id'] for song in group)}
-
-            for attempt in range(2):
-                access_token = check_for_refresh()
-                headers = {'Authorization': 'Bearer {}'.format(access_token)}
-
-                r = get(url, params=params, headers=headers)
-
-                if r.status_code == 200:
-                    break
-            else:  # no break
-                print('Error accessing url: {}'.format(url))
-                r.raise_for_status()
-
-            data = r.json()
-            audio_features.extend(data['audio_features'])
+        print('Audio features cache: {audio_features_hits} hits, '
+              '{audio_features_misses} misses'.format(**stats))
 
         audio_data = [(song['id'],
                        song['acousticness'],
@@ -412,84 +464,53 @@ class GetAudioFeatures(Task):
                                            'time_signature',
                                            'valence'])
 
-        with self.output().temporary_path() as temp_path:
-            audio_data_df.to_pickle(temp_path, compression=None)
+        write_frame(audio_data_df, self.output())
 
 
 @requires(GetSavedTracks)
-class CleanTracks(Task):
+class CleanTracks(ArtifactTask):
 
     def output(self):
-        import os
+        return arrow_target('clean_tracks')
 
-        file_location = os.path.expanduser('~/Temp/luigi/spotify/{}.pckl')
-        return LocalTarget(file_location.format('clean_tracks'), format=Nop)
+    def artifact_inputs(self):
+        return self.input()[0]
 
     def run(self):
-        import pickle
-        from pandas import DataFrame
+        columns = ['id',
+                   'name',
+                   'main_artist',
+                   'available_in_us',
+                   'duration_ms',
+                   'explicit',
+                   'uri',
+                   'preview_url',
+                   ]
 
-        self.output().makedirs()
+        song_data_df = read_frame(self.input()[0], columns=columns)
 
-        with self.input()[0].open('r') as f:
-            songs = pickle.load(f)
-
-        songs = [song['track'] for song in songs]
-
-        song_data = [(song['id'],
-                      song['name'],
-                      song['artists'][0]['id'],
-                      'US' in song['available_markets'],
-                      song['duration_ms'],
-                      song['explicit'],
-                      song['uri'],
-                      song['preview_url'])
-                     for song in songs]
-
-        song_data_df = DataFrame(song_data,
-                                 columns=['id',
-                                          'name',
-                                          'main_artist',
-                                          'available_in_us',
-                                          'duration_ms',
-                                          'explicit',
-                                          'uri',
-                                          'preview_url'])
-
-        with self.output().temporary_path() as temp_path:
-            song_data_df.to_pickle(temp_path, compression=None)
+        write_frame(song_data_df, self.output())
 
 
 @requires(CleanTracks, GetAudioFeatures)
-class MergeTracks(Task):
+class MergeTracks(ArtifactTask):
 
     def output(self):
-        import os
-
-        file_location = os.path.expanduser('~/Temp/luigi/spotify/{}.pckl')
-        return LocalTarget(file_location.format('complete_tracks'), format=Nop)
+        return arrow_target('complete_tracks')
 
     def run(self):
-        import pickle
         from pandas import merge
 
-        self.output().makedirs()
-
-        with self.input()[0].open('r') as f:
-            songs = pickle.load(f)
-
-        with self.input()[1].open('r') as f:
-            features = pickle.load(f)
+        songs = read_frame(self.input()[0])
+        features = read_frame(self.input()[1])
 
         tracks = merge(songs, features, on='id')
 
-        with self.output().temporary_path() as temp_path:
-            tracks.to_pickle(temp_path, compression=None)
+        write_frame(tracks, self.output())
 
 
 @requires(CleanArtists)
-class ArtistList(TransactionFactTable):
-    priority = 2
+class ArtistList(UpsertDimensionTable):
     pass
 
 
@@ -499,8 +520,7 @@ class GenreXArtistList(TransactionFactTable):
 
 
 @requires(CleanAlbums)
-class AlbumList(TransactionFactTable):
-    priority = 2
+class AlbumList(UpsertDimensionTable):
     pass
 
 
@@ -515,7 +535,7 @@ class ArtistXAlbumList(TransactionFactTable):
 
 
 @requires(MergeTracks)
-class SavedTracksList(TransactionFactTable):
+class SavedTracksList(UpsertDimensionTable):
     pass
 
 
@@ -536,36 +556,44 @@ class CopyTracks(CopyWrapper):
             {'table_type': GenreXArtistList,
              'fn': ExplodeGenresArtists,
              'table': 'artist_genres',
-             'columns': ['artist_id',
-                         'genre_name',
+             'columns': ['artist_int_id',
+                         'genre_int_id',
                          ],
-             'id_cols': ['artist_id',
-                         'genre_name',
+             'id_cols': ['artist_int_id',
+                         'genre_int_id',
                          ],
              'date_cols': [],
-             'merge_cols': HashableDict()},
+             'merge_cols': HashableDict(
+                 artist_id=('artists', 'id', 'artist_int_id', False),
+                 genre_name=('genres', 'genre_name', 'genre_int_id',
+                             True))},
             {'table_type': ArtistXAlbumList,
              'fn': ExplodeArtistsAlbums,
              'table': 'albums_x_artists',
-             'columns': ['album_id',
-                         'artist_id',
+             'columns': ['album_int_id',
+                         'artist_int_id',
                          ],
-             'id_cols': ['album_id',
-                         'artist_id',
+             'id_cols': ['album_int_id',
+                         'artist_int_id',
                          ],
              'date_cols': [],
-             'merge_cols': HashableDict()},
+             'merge_cols': HashableDict(
+                 album_id=('albums', 'id', 'album_int_id', False),
+                 artist_id=('artists', 'id', 'artist_int_id', False))},
             {'table_type': GenreXAlbumList,
              'fn': ExplodeGenresAlbums,
              'table': 'album_genres',
-             'columns': ['album_id',
-                         'genre_name',
+             'columns': ['album_int_id',
+                         'genre_int_id',
                          ],
-             'id_cols': ['album_id',
-                         'genre_name',
+             'id_cols': ['album_int_id',
+                         'genre_int_id',
                          ],
              'date_cols': [],
-             'merge_cols': HashableDict()},
+             'merge_cols': HashableDict(
+                 album_id=('albums', 'id', 'album_int_id', False),
+                 genre_name=('genres', 'genre_name', 'genre_int_id',
+                             True))},
             {'table_type': AlbumList,
              'fn':         CleanAlbums,
              'table':      'albums',
@@ -611,3 +639,9 @@ class CopyTracks(CopyWrapper):
              'date_cols': [],
              'merge_cols': HashableDict()},
             ]
+
+    def after_load(self):
+        # only move past the saved tracks once the tracks table holds them
+        if self.loaded('tracks'):
+            commit_state('saved_tracks_watermark',
+                         self.clone(GetSavedTracks).output()[3])
@@ -1,78 +1,41 @@
 #! /usr/bin/env python3
 
 from luigi import Task, LocalTarget
-from luigi.format import Nop
 from luigi.util import requires, inherits
 from postgres_templates import TransactionFactTable, CopyWrapper, HashableDict
-from spotify_api import check_for_refresh
+from spotify_client import api_url, get, get_items, get_playlist_track_ids
+from spotify_client import nested_page_workers
+from sync_state import commit_state, load_state
+from intermediates import arrow_target, read_frame, read_records
+from intermediates import write_frame, write_records
 
 
 class GetGenrePlaylists(Task):
 
     def output(self):
-        import os
-
-        file_location = os.path.expanduser('~/Temp/luigi/spotify/{}.pckl')
-        return LocalTarget(file_location.format('playlists'), format=Nop)
+        return arrow_target('playlists')
 
     def run(self):
-        from requests import get
-        import pickle
-
-        self.output().makedirs()
-
-        access_token = check_for_refresh()
-
-        headers = {'Authorization': 'Bearer {}'.format(access_token)}
-
-        user_url = 'https://api.spotify.com/v1/me'
-        r = get(user_url, headers=headers)
-        user_data = r.json()
-
-        url = f'https://api.spotify.com/v1/users/{user_data["id"]}/playlists'
-        params = {'limit': 50}
+        user_data = get(api_url('me'))
 
-        playlists = []
+        url = api_url('users/{}/playlists'.format(user_data['id']))
+        playlists = get_items(url, params={'limit': 50})
 
-        while url is not None:
-            for attempt in range(2):
-                access_token = check_for_refresh()
-                headers = {'Authorization': 'Bearer {}'.format(access_token)}
-
-                r = get(url, params=params, headers=headers)
-
-                if r.status_code == 200:
-                    break
-            else:  # no break
-                print('Error accessing url: {}'.format(url))
-                r.raise_for_status()
-
-            data = r.json()
-
-            playlists.extend(data['items'])
-            url = data['next']
-
-        with self.output().open('w') as f:
-            pickle.dump(playlists, f, protocol=-1)
+        write_records(playlists, self.output())
 
 
 @requires(GetGenrePlaylists)
 class FilterPlaylists(Task):
 
     def output(self):
-        import os
-
-        file_location = os.path.expanduser('~/Temp/luigi/spotify/{}.pckl')
-        return LocalTarget(file_location.format('filtered_playlists'),
-                           format=Nop)
+        return arrow_target('filtered_playlists')
 
     def run(self):
-        import pickle
-
-        self.output().makedirs()
-
-        with self.input().open('r') as f:
-            playlists = pickle.load(f)
+        playlists = read_records(self.input(), columns=['id',
+                                                        'name',
+                                                        'snapshot_id',
+                                                        'tracks',
+                                                        ])
 
         names = [x['name'] for x in playlists]
         start = names.index('Deal with later') + 1
@@ -83,93 +46,94 @@ class FilterPlaylists(Task):
                               for playlist in playlists
                               if playlist['name'] in names]
 
-        with self.output().open('w') as f:
-            pickle.dump(filtered_playlists, f, protocol=-1)
+        write_records(filtered_playlists, self.output())
 
 
 @requires(FilterPlaylists)
 class PlaylistInfos(Task):
 
     def output(self):
-        import os
-
-        file_location = os.path.expanduser('~/Temp/luigi/spotify/{}.pckl')
-        return LocalTarget(file_location.format('playlist_infos'),
-                           format=Nop)
+        return arrow_target('playlist_infos')
 
     def run(self):
-        import pickle
-        from pandas import DataFrame
-
-        self.output().makedirs()
-
-        with self.input().open('r') as f:
-            playlists = pickle.load(f)
-
-        playlists_df = DataFrame(((x['id'], x['name']) for x in playlists),
-                                 columns=['playlist_id', 'genre_name'])
+        playlists_df = read_frame(self.input(), columns=['id', 'name'])
+        playlists_df.columns = ['playlist_id', 'genre_name']
+        playlists_df = playlists_df.astype({'genre_name': 'category'})
 
-        with self.output().temporary_path() as temp_path:
-            playlists_df.to_pickle(temp_path, compression=None)
+        write_frame(playlists_df, self.output())
 
 
 @requires(FilterPlaylists)
 class GetTracksByPlaylist(Task):
+    """
+    Get the track ids of every filtered playlist.
+
+    Only playlists whose `snapshot_id` changed since the last successful load
+    are fetched again; the others reuse the track ids saved with their
+    snapshot. Up to `spotify_cfg.playlist_workers` playlists are fetched at
+    once, and the pages of each playlist are fetched by offset.
+
+    The new snapshots are written to `pending_snapshots()` and saved by
+    `CopyTracks` once the tables are loaded.
+    """
 
     def output(self):
+        return arrow_target('tracks_playlists')
+
+    def pending_snapshots(self):
         import os
 
-        file_location = os.path.expanduser('~/Temp/luigi/spotify/{}.pckl')
-        return LocalTarget(file_location.format('tracks_playlists'),
-                           format=Nop)
+        return LocalTarget(os.path.expanduser('~/Temp/luigi/spotify/'
+                                              'playlist_snapshots.json'))
 
     def run(self):
-        from requests import get
-        from itertools import cycle
-        import pickle
-        from pandas import DataFrame
+        from concurrent.futures import ThreadPoolExecutor
+        from configs import spotify_cfg
+        import json
+        from pandas import DataFrame, concat
 
-        self.output().makedirs()
+        playlists = read_records(self.input())
 
-        with self.input().open('r') as f:
-            playlists = pickle.load(f)
+        cfg = spotify_cfg()
+        page_workers = nested_page_workers(cfg.playlist_workers)
+        snapshots = load_state('playlist_snapshots', {})
 
-        params = {'limit': 100, 'fields': 'items(track(id)),next'}
+        def get_tracks(playlist):
+            saved = snapshots.get(playlist['id'], {})
 
-        playlist_tracks = []
+            if saved.get('snapshot_id') == playlist['snapshot_id']:
+                return saved['tracks']
 
-        for playlist in playlists:
-            url = playlist['tracks']['href']
-            tracks = []
+            return get_playlist_track_ids(playlist['tracks']['href'],
+                                          page_workers)
 
-            while url is not None:
-                for attempt in range(2):
-                    access_token = check_for_refresh()
-                    headers = {'Authorization': f'Bearer {access_token}'}
+        new_snapshots = {}
+        frames = []
 
-                    r = get(url, params=params, headers=headers)
+        with ThreadPoolExecutor(max_workers=cfg.playlist_workers) as executor:
+            for playlist, tracks in zip(playlists,
+                                        executor.map(get_tracks, playlists)):
+                new_snapshots[playlist['id']] = {
+                    'snapshot_id': playlist['snapshot_id'],
+                    'tracks': tracks,
+                }
 
-                    if r.status_code == 200:
-                        break
-                else:  # no break
-                    print('Error accessing url: {}'.format(url))
-                    r.raise_for_status()
+                frames.append(DataFrame({'genre_name': playlist['name'],
+                                         'track_id': tracks},
+                                        columns=['genre_name', 'track_id']))
 
-                data = r.json()
+        if frames:
+            playlists_df = concat(frames, ignore_index=True)
+        else:
+            playlists_df = DataFrame(columns=['genre_name', 'track_id'])
 
-                tracks.extend([x['track']['id'] for x in data['items']])
+        # one genre name per track, and tracks in several playlists
+        playlists_df = playlists_df.astype('category')
 
-                url = data['next']
+        write_frame(playlists_df, self.output())
 
-            playlist_tracks.extend([x
-                                    for x in zip(cycle([playlist['name']]),
-                                                 tracks)])
-
-        playlists_df = DataFrame(playlist_tracks,
-                                 columns=['genre_name', 'track_id'])
-
-        with self.output().temporary_path() as temp_path:
-            playlists_df.to_pickle(temp_path, compression=None)
+        with self.pending_snapshots().open('w') as f:
+            json.dump(new_snapshots, f)
 
 
 @requires(PlaylistInfos)
@@ -189,22 +153,31 @@ class CopyTracks(CopyWrapper):
              'fn': GetTracksByPlaylist,
              'table': 'playlists_x_tracks',
              'columns': ['track_id',
-                         'genre_name',
+                         'genre_int_id',
                          ],
              'id_cols': ['track_id',
-                         'genre_name',
+                         'genre_int_id',
                          ],
              'date_cols': [],
-             'merge_cols': HashableDict()},
+             'merge_cols': HashableDict(
+                 genre_name=('genres', 'genre_name', 'genre_int_id',
+                             True))},
             {'table_type': PlaylistsList,
              'fn': PlaylistInfos,
              'table': 'playlists',
              'columns': ['playlist_id',
-                         'genre_name',
+                         'genre_int_id',
                          ],
              'id_cols': ['playlist_id',
-                         'genre_name',
+                         'genre_int_id',
                          ],
              'date_cols': [],
-             'merge_cols': HashableDict()},
+             'merge_cols': HashableDict(
+                 genre_name=('genres', 'genre_name', 'genre_int_id',
+                             True))},
             ]
+
+    def after_load(self):
+        if self.loaded('playlists_x_tracks'):
+            commit_state('playlist_snapshots',
+                         self.clone(GetTracksByPlaylist).pending_snapshots())
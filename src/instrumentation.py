@@ -0,0 +1,369 @@
+#! /usr/bin/env python3
+
+import json
+import os
+from collections import Counter
+from os import path
+from threading import Lock
+from time import monotonic, time
+
+from luigi import Event, Task
+from luigi.task import flatten
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+RUN_ID = '{:.0f}-{}'.format(time(), os.getpid())
+
+
+class Metrics:
+    """
+    Thread-safe counters and latency histograms of the current process.
+
+    Metrics are identified by a name and a set of labels, e.g.
+    `spotify_request_seconds` with `endpoint='albums'`. Histograms count
+    observations per upper bound in `LATENCY_BUCKETS`, non-cumulatively.
+    """
+
+    def __init__(self):
+        self.counters = Counter()
+        self.histograms = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def increment(self, name, value=1, **labels):
+        with self._lock:
+            self.counters[self.key(name, labels)] += value
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        bucket = next(i for i, bound in enumerate(LATENCY_BUCKETS)
+                      if value <= bound)
+
+        with self._lock:
+            histogram = self.histograms.setdefault(
+                key, {'buckets': [0] * len(LATENCY_BUCKETS),
+                      'sum': 0.0,
+                      'count': 0})
+            histogram['buckets'][bucket] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return (Counter(self.counters),
+                    {key: {'buckets': list(value['buckets']),
+                           'sum': value['sum'],
+                           'count': value['count']}
+                     for key, value in self.histograms.items()})
+
+    def since(self, snapshot):
+        """
+        Return the metrics recorded since `snapshot`, as JSON-ready lists.
+        """
+
+        old_counters, old_histograms = snapshot
+        counters, histograms = self.snapshot()
+
+        counters.subtract(old_counters)
+        empty = {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0, 'count': 0}
+        changed = []
+
+        for key, value in histograms.items():
+            old = old_histograms.get(key, empty)
+
+            if value['count'] > old['count']:
+                changed.append((key, {
+                    'buckets': [new - prev for new, prev
+                                in zip(value['buckets'], old['buckets'])],
+                    'sum': value['sum'] - old['sum'],
+                    'count': value['count'] - old['count'],
+                }))
+
+        return ([{'name': name, 'labels': dict(labels), 'value': value}
+                 for (name, labels), value in counters.items() if value],
+                [{'name': name, 'labels': dict(labels), **value}
+                 for (name, labels), value in changed])
+
+
+metrics = Metrics()
+
+
+def record_request(endpoint, seconds, response):
+    """
+    Record one HTTP request to the Spotify API.
+    """
+
+    metrics.observe('spotify_request_seconds', seconds, endpoint=endpoint)
+    metrics.increment('spotify_requests_total',
+                      endpoint=endpoint,
+                      status=str(response.status_code))
+    metrics.increment('spotify_response_bytes_total',
+                      len(response.content),
+                      endpoint=endpoint)
+
+
+def record_table_load(table, staged, written, copy_seconds):
+    """
+    Record one table load: rows COPYed into the staging table, rows written
+    to the table, and how long the COPY took.
+    """
+
+    metrics.increment('table_rows_staged_total', staged, table=table)
+    metrics.increment('table_rows_written_total', written, table=table)
+    metrics.increment('table_rows_skipped_total', staged - written,
+                      table=table)
+    metrics.increment('table_copy_seconds_total', copy_seconds, table=table)
+
+
+def count_rows(targets):
+    """
+    Count the rows of each Arrow file among `targets`, from its metadata.
+
+    :return: Dictionary of file name, without `.arrow`, to its number of
+             rows, or `None` if there are no Arrow files.
+    """
+    import pyarrow as pa
+
+    rows = {}
+
+    for target in flatten(targets):
+        filepath = getattr(target, 'path', '')
+
+        if filepath.endswith('.arrow') and path.exists(filepath):
+            with pa.memory_map(filepath) as source:
+                # zero-copy, so no column data is read from disk
+                table = pa.ipc.open_file(source).read_all()
+                rows[path.basename(filepath)[:-len('.arrow')]] = table.num_rows
+
+    return rows or None
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of the process to its current size, so
+    that `peak_rss_mb` measures from now on.
+
+    :return: Whether the kernel allowed it; only Linux does.
+    """
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+
+    return True
+
+
+def peak_rss_mb():
+    """
+    The peak resident set size of the process since `reset_peak_rss`, in MB,
+    including what it already held then.
+    """
+
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                # reported in kilobytes
+                return int(line.split()[1]) / 1024
+
+
+def rate_limiter_stats():
+    from spotify_api import get_rate_limiter
+
+    return Counter(get_rate_limiter().stats)
+
+
+def report_path():
+    from configs import instrumentation_cfg
+
+    return path.join(path.expanduser(instrumentation_cfg().report_dir),
+                     RUN_ID + '.jsonl')
+
+
+def write_report_line(line):
+    filepath = report_path()
+    os.makedirs(path.dirname(filepath), exist_ok=True)
+
+    # single appends are atomic enough for concurrent worker processes
+    with open(filepath, 'a') as f:
+        f.write(json.dumps(line) + '\n')
+
+
+def read_report(filepath):
+    with open(filepath) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+
+    return '{%s}' % ','.join('{}="{}"'.format(name, str(value)
+                                              .replace('\\', '\\\\')
+                                              .replace('"', '\\"'))
+                             for name, value in sorted(labels.items()))
+
+
+def prometheus_text(report):
+    """
+    Aggregate the task lines of a run report into Prometheus' text exposition
+    format.
+    """
+
+    gauges = {}
+    counters = Counter()
+    histograms = {}
+
+    for line in report:
+        family = {'task_family': line['task_family']}
+
+        key = Metrics.key('luigi_task_wall_seconds', family)
+        gauges[key] = gauges.get(key, 0) + line['wall_seconds']
+
+        if line['peak_rss_mb'] is not None:
+            key = Metrics.key('luigi_task_peak_rss_megabytes', family)
+            gauges[key] = max(gauges.get(key, 0), line['peak_rss_mb'])
+
+        counters[Metrics.key('luigi_tasks_total',
+                             dict(family, status=line['status']))] += 1
+
+        for name in ['rows_in', 'rows_out']:
+            for target, rows in (line[name] or {}).items():
+                counters[Metrics.key('luigi_task_' + name + '_total',
+                                     dict(family, target=target))] += rows
+
+        for name, value in line['rate_limiter'].items():
+            counters[Metrics.key('spotify_rate_limiter_' + name + '_total',
+                                 {})] += value
+
+        for counter in line['counters']:
+            counters[Metrics.key(counter['name'],
+                                 counter['labels'])] += counter['value']
+
+        for histogram in line['histograms']:
+            key = Metrics.key(histogram['name'], histogram['labels'])
+            total = histograms.setdefault(
+                key, {'buckets': [0] * len(LATENCY_BUCKETS),
+                      'sum': 0.0,
+                      'count': 0})
+            total['buckets'] = [a + b for a, b in zip(total['buckets'],
+                                                      histogram['buckets'])]
+            total['sum'] += histogram['sum']
+            total['count'] += histogram['count']
+
+    lines = []
+    typed = set()
+
+    def add(name, kind, labels, value, suffix=''):
+        if name not in typed:
+            lines.append('# TYPE {} {}'.format(name, kind))
+            typed.add(name)
+
+        lines.append('{}{}{} {}'.format(name, suffix, format_labels(labels),
+                                        value))
+
+    for (name, labels), value in sorted(gauges.items()):
+        add(name, 'gauge', dict(labels), value)
+
+    for (name, labels), value in sorted(counters.items()):
+        add(name, 'counter', dict(labels), value)
+
+    for (name, labels), value in sorted(histograms.items()):
+        labels = dict(labels)
+        cumulative = 0
+
+        for bound, count in zip(LATENCY_BUCKETS, value['buckets']):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            add(name, 'histogram', dict(labels, le=le), cumulative, '_bucket')
+
+        add(name, 'histogram', labels, value['sum'], '_sum')
+        add(name, 'histogram', labels, value['count'], '_count')
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(filepath):
+    """
+    Atomically write the current run report to `filepath` in Prometheus'
+    textfile collector format.
+    """
+    from tempfile import NamedTemporaryFile
+
+    filepath = path.expanduser(filepath)
+    os.makedirs(path.dirname(filepath), exist_ok=True)
+
+    with NamedTemporaryFile('w',
+                            dir=path.dirname(filepath),
+                            prefix='.' + path.basename(filepath) + '.',
+                            delete=False) as f:
+        f.write(prometheus_text(read_report(report_path())))
+
+    os.replace(f.name, filepath)
+
+
+_started = {}
+
+
+@Task.event_handler(Event.START)
+def task_started(task):
+    from configs import instrumentation_cfg
+
+    if not instrumentation_cfg().enabled:
+        return
+
+    _started[task.task_id] = {'started_at': time(),
+                              'clock': monotonic(),
+                              'rows_in': count_rows(task.input()),
+                              'peak_reset': reset_peak_rss(),
+                              'metrics': metrics.snapshot(),
+                              'rate_limiter': rate_limiter_stats(),
+                              }
+
+
+def task_finished(task, status):
+    from configs import instrumentation_cfg
+
+    cfg = instrumentation_cfg()
+    started = _started.pop(task.task_id, None)
+
+    if not cfg.enabled or started is None:
+        return
+
+    counters, histograms = metrics.since(started['metrics'])
+    rate_limiter = rate_limiter_stats()
+    rate_limiter.subtract(started['rate_limiter'])
+
+    write_report_line({'run_id': RUN_ID,
+                       'task_id': task.task_id,
+                       'task_family': task.task_family,
+                       'status': status,
+                       'started_at': started['started_at'],
+                       'wall_seconds': monotonic() - started['clock'],
+                       'peak_rss_mb': (peak_rss_mb()
+                                       if started['peak_reset'] else None),
+                       'rows_in': started['rows_in'],
+                       'rows_out': count_rows(task.output()),
+                       'rate_limiter': {name: value
+                                        for name, value in rate_limiter.items()
+                                        if value},
+                       'counters': counters,
+                       'histograms': histograms,
+                       })
+
+    if cfg.prometheus_path:
+        write_prometheus(cfg.prometheus_path)
+
+
+@Task.event_handler(Event.SUCCESS)
+def task_succeeded(task):
+    task_finished(task, 'success')
+
+
+@Task.event_handler(Event.FAILURE)
+def task_failed(task, exception):
+    task_finished(task, 'failure')
@@ -0,0 +1,114 @@
+#! /usr/bin/env python3
+
+from contextlib import contextmanager
+from luigi import LocalTarget
+from luigi.format import Nop
+
+
+def arrow_target(name):
+    """
+    The local target for the intermediate `name`, stored as an uncompressed
+    Arrow IPC (Feather v2) file so that it can be memory-mapped on read.
+    """
+    import os
+
+    file_location = os.path.expanduser('~/Temp/luigi/spotify/{}.arrow')
+    return LocalTarget(file_location.format(name), format=Nop)
+
+
+def sparse_target(name):
+    """
+    The local target for the sparse matrix `name`, stored in scipy's `.npz`
+    format.
+    """
+    import os
+
+    file_location = os.path.expanduser('~/Temp/luigi/spotify/{}.npz')
+    return LocalTarget(file_location.format(name), format=Nop)
+
+
+def write_sparse(matrix, target):
+    from scipy import sparse
+
+    target.makedirs()
+
+    with target.temporary_path() as temp_path:
+        with open(temp_path, 'wb') as f:
+            sparse.save_npz(f, matrix.tocsr())
+
+
+def read_sparse(target):
+    from scipy import sparse
+
+    return sparse.load_npz(target.path).tocsr()
+
+
+def write_table(table, target):
+    from pyarrow import feather
+
+    target.makedirs()
+
+    with target.temporary_path() as temp_path:
+        feather.write_feather(table, temp_path, compression='uncompressed')
+
+
+def read_table(target, columns=None):
+    """
+    Memory-map `target` and return only `columns` (all if `None`) as a
+    `pyarrow.Table`, without reading the other columns from disk.
+    """
+    from pyarrow import feather
+
+    return feather.read_table(target.path, columns=columns, memory_map=True)
+
+
+def write_frame(df, target):
+    from pyarrow import Table
+
+    table = Table.from_pandas(df, preserve_index=False)
+    write_table(table, target)
+
+
+def read_frame(target, columns=None):
+    return read_table(target, columns).to_pandas()
+
+
+def write_records(records, target):
+    """
+    Write a list of (nested) dictionaries, such as raw API objects, as one
+    column per top-level key.
+    """
+    import pyarrow as pa
+
+    if records:
+        table = pa.Table.from_struct_array(pa.array(records))
+    else:
+        table = pa.table({})
+
+    write_table(table, target)
+
+
+def read_records(target, columns=None):
+    return read_table(target, columns).to_pylist()
+
+
+@contextmanager
+def record_writer(target, schema):
+    """
+    Write records to `target` in chunks as they arrive, so that only one
+    chunk needs to be held in memory.
+
+    Yields a function that takes a list of flat dictionaries matching
+    `schema` and appends them to the file as one record batch.
+    """
+    from pyarrow import ipc, RecordBatch
+
+    target.makedirs()
+
+    with target.temporary_path() as temp_path:
+        with ipc.new_file(temp_path, schema) as writer:
+            def write(records):
+                batch = RecordBatch.from_pylist(records, schema=schema)
+                writer.write_batch(batch)
+
+            yield write
@@ -0,0 +1,334 @@
+#! /usr/bin/env python3
+
+import datetime
+import numpy as np
+from luigi import Task, LocalTarget
+from luigi.format import Nop
+from luigi.parameter import BoolParameter, DateParameter
+from luigi.util import requires, inherits
+from postgres_templates import UpsertDimensionTable, HashableDict
+from postgres_templates import read_connection
+from get_audio_features import MergeTracks, CopyTracks
+from intermediates import arrow_target, read_frame, write_frame
+from similarity import TrackSimilarity
+from playlist_sync import sync_playlists
+from sync_state import load_state, save_state
+
+
+def squared_distances(points, centroids):
+    return (np.einsum('ij,ij->i', points, points)[:, None]
+            - 2 * points @ centroids.T
+            + np.einsum('ij,ij->i', centroids, centroids)[None, :])
+
+
+def nearest_centroids(points, centroids, chunk_size=8192):
+    """
+    Return the index of, and distance to, the nearest centroid of every
+    point, computing at most `chunk_size` rows of distances at once.
+    """
+
+    labels = np.empty(len(points), dtype='int64')
+    distances = np.empty(len(points), dtype='float32')
+
+    for start in range(0, len(points), chunk_size):
+        squared = squared_distances(points[start:start + chunk_size],
+                                    centroids)
+        nearest = squared.argmin(axis=1)
+        stop = start + len(nearest)
+
+        labels[start:stop] = nearest
+        distances[start:stop] = np.sqrt(np.maximum(
+            squared[np.arange(len(nearest)), nearest], 0))
+
+    return labels, distances
+
+
+def kmeans_plus_plus(points, k, rng):
+    """
+    Pick `k` initial centroids among `points`, each one with a probability
+    proportional to its squared distance to the centroids picked so far.
+    """
+
+    centroids = [points[rng.integers(len(points))]]
+    closest = squared_distances(points, centroids[0][None, :])[:, 0]
+
+    for _ in range(1, k):
+        closest = np.maximum(closest, 0)
+
+        if closest.sum() > 0:
+            choice = rng.choice(len(points), p=closest / closest.sum())
+        else:
+            choice = rng.integers(len(points))
+
+        centroids.append(points[choice])
+        closest = np.minimum(
+            closest, squared_distances(points, points[choice][None, :])[:, 0])
+
+    return np.array(centroids)
+
+
+def mini_batch_kmeans(points, k, batch_size, iterations, seed=0):
+    """
+    Cluster `points` with mini-batch k-means (Sculley, 2010): every step
+    assigns a random batch to the nearest centroids and moves each centroid
+    towards the mean of its batch points, with a learning rate of one over
+    the number of points it has been assigned so far.
+
+    Only the batch and the centroids take part in a step, so the cost of a
+    fit doesn't grow with the size of the library.
+
+    :return: Tuple of (float32 centroids, number of points each centroid was
+             assigned during the fit).
+    """
+
+    rng = np.random.default_rng(seed)
+    k = min(k, len(points))
+
+    sample = points[rng.choice(len(points),
+                               min(len(points), 10 * batch_size),
+                               replace=False)]
+    centroids = kmeans_plus_plus(sample, k, rng).astype('float64')
+    counts = np.zeros(k)
+
+    for _ in range(iterations):
+        batch = points[rng.integers(0, len(points), batch_size)]
+        labels, _ = nearest_centroids(batch, centroids)
+
+        batch_counts = np.bincount(labels, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, batch)
+
+        counts += batch_counts
+        moved = batch_counts > 0
+        centroids[moved] += ((sums[moved]
+                              - batch_counts[moved, None] * centroids[moved])
+                             / counts[moved, None])
+
+    return centroids.astype('float32'), counts
+
+
+def model_path():
+    import os
+    from configs import cache_cfg
+
+    return os.path.join(os.path.expanduser(cache_cfg().path),
+                        'track_clusters.npz')
+
+
+def load_model():
+    """
+    Return the saved clustering model, or `None` if there is none yet.
+    """
+
+    try:
+        with np.load(model_path()) as model:
+            return dict(model)
+    except FileNotFoundError:
+        return None
+
+
+def commit_model(target):
+    """
+    Save the model that `ClusterTracks` wrote to `target`, once the clusters
+    it assigned have been loaded.
+    """
+    import os
+    import shutil
+
+    if target.exists():
+        filepath = model_path()
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+
+        temp_path = '{}.{}'.format(filepath, os.getpid())
+        shutil.copyfile(target.path, temp_path)
+        os.replace(temp_path, filepath)
+
+
+@requires(MergeTracks)
+class ClusterTracks(Task):
+    """
+    Assign every track to a mood cluster, based on its audio features.
+
+    The first run, or a run with `refit`, standardizes the features (as
+    `TrackSimilarity` does) and fits `mood_cfg.clusters` centroids with
+    mini-batch k-means. The centroids and the normalization are saved with
+    the load, so later runs only assign the new tracks to the existing
+    centroids. A refit may renumber the clusters.
+
+    The model is written to `pending_model()` and saved by
+    `CopyMoodClusters` once the tables are loaded.
+
+    :param refit: Fit new centroids instead of reusing the saved ones. Needs
+                  the whole library, so it can't be combined with
+                  `incremental`; neither can the first run.
+    """
+
+    refit = BoolParameter(default=False)
+
+    def output(self):
+        return arrow_target('track_clusters')
+
+    def pending_model(self):
+        import os
+
+        return LocalTarget(os.path.expanduser('~/Temp/luigi/spotify/'
+                                              'track_clusters.npz'),
+                           format=Nop)
+
+    def run(self):
+        from configs import mood_cfg
+        from pandas import DataFrame
+
+        if self.refit and self.incremental:
+            raise ValueError('A refit needs every saved track, so it can\'t '
+                             'be run incrementally')
+
+        model = None if self.refit else load_model()
+
+        if model is None and self.incremental:
+            raise ValueError('There is no saved model yet, and the first fit '
+                             'needs every saved track, so it can\'t be run '
+                             'incrementally')
+
+        tracks = read_frame(self.input())
+
+        if tracks.empty:
+            clusters = DataFrame({'track_id': [], 'cluster': [],
+                                  'distance': []})
+            write_frame(clusters.astype({'cluster': 'int16',
+                                         'distance': 'float32'}),
+                        self.output())
+            return
+
+        if model is None:
+            cfg = mood_cfg()
+            space = TrackSimilarity.from_frame(tracks)
+            centroids, counts = mini_batch_kmeans(space.matrix,
+                                                  cfg.clusters,
+                                                  cfg.batch_size,
+                                                  cfg.iterations,
+                                                  cfg.seed)
+            model = dict(space.normalization(),
+                         centroids=centroids,
+                         counts=counts)
+
+            print('Fitted {} clusters on {} tracks'.format(len(centroids),
+                                                           len(tracks)))
+        else:
+            space = TrackSimilarity.from_frame(tracks, normalization=model)
+
+        labels, distances = nearest_centroids(space.matrix,
+                                              model['centroids'])
+
+        write_frame(DataFrame({'track_id': tracks['id'],
+                               'cluster': labels.astype('int16'),
+                               'distance': distances}),
+                    self.output())
+
+        pending = self.pending_model()
+        pending.makedirs()
+
+        with pending.temporary_path() as temp_path:
+            with open(temp_path, 'wb') as f:
+                np.savez(f, **model)
+
+
+@requires(ClusterTracks)
+class TrackClusterList(UpsertDimensionTable):
+    pass
+
+
+@inherits(ClusterTracks)
+class CopyMoodClusters(CopyTracks):
+    """
+    Load the saved tracks like `CopyTracks`, along with their mood clusters.
+    """
+
+    jobs = CopyTracks.jobs + [
+        {'table_type': TrackClusterList,
+         'fn': ClusterTracks,
+         'table': 'track_clusters',
+         'columns': ['track_id',
+                     'cluster',
+                     'distance',
+                     ],
+         'id_cols': ['track_id'],
+         'date_cols': [],
+         'merge_cols': HashableDict()},
+    ]
+
+    def after_load(self):
+        super().after_load()
+
+        if self.loaded('track_clusters'):
+            commit_model(self.clone(ClusterTracks).pending_model())
+
+
+@inherits(CopyMoodClusters)
+class SyncMoodPlaylists(Task):
+    """
+    Make the playlist of each cluster in `mood_cfg.playlists` hold exactly
+    the tracks of that cluster.
+
+    Only the tracks that differ are removed or added, so tracks already in a
+    playlist keep their place, and new ones are appended closest to the
+    centroid first. Only the first sync orders a whole playlist by distance
+    to the centroid. Playlists that haven't changed on either side since the
+    last sync are skipped, see `sync_playlists`. The result of each day's
+    sync is kept as the output.
+
+    :param date: The day of the sync.
+    """
+
+    date = DateParameter(default=datetime.date.today())
+
+    def requires(self):
+        return self.clone(CopyMoodClusters)
+
+    def output(self):
+        import os
+        from configs import cache_cfg
+
+        return LocalTarget(os.path.join(os.path.expanduser(cache_cfg().path),
+                                        'mood_playlists',
+                                        '{:%Y-%m-%d}.json'.format(self.date)))
+
+    def cluster_tracks(self):
+        """
+        Return a dictionary of cluster to the ids of its tracks.
+        """
+
+        connection = read_connection()
+
+        try:
+            cursor = connection.cursor()
+            cursor.execute("""SELECT cluster, track_id FROM track_clusters
+                              ORDER BY cluster, distance, track_id;""")
+            rows = cursor.fetchall()
+        finally:
+            connection.close()
+
+        tracks = {}
+
+        for cluster, track_id in rows:
+            tracks.setdefault(cluster, []).append(track_id)
+
+        return tracks
+
+    def run(self):
+        import json
+        from configs import mood_cfg
+
+        tracks = self.cluster_tracks()
+        desired = {playlist_id: tracks.get(int(cluster), [])
+                   for cluster, playlist_id in mood_cfg().playlists.items()}
+
+        synced = sync_playlists(desired, load_state('mood_playlists'))
+        save_state('mood_playlists', synced)
+
+        for playlist_id, result in synced.items():
+            print('Playlist {}: {} removed, {} added'.format(
+                playlist_id, result['removed'], result['added']))
+
+        with self.output().open('w') as f:
+            json.dump(synced, f)
@@ -0,0 +1,131 @@
+#! /usr/bin/env python3
+
+from more_itertools import chunked
+from spotify_client import api_url, delete, get, get_playlist_track_ids, post
+from spotify_client import nested_page_workers
+
+# the most URIs the API accepts per add or remove request
+MAX_URIS = 100
+
+
+def track_uri(track_id):
+    return 'spotify:track:' + track_id
+
+
+def playlist_diff(current, desired):
+    """
+    Return the track ids to remove from and add to a playlist holding
+    `current` so that it holds every track of `desired`, and nothing else.
+
+    Tracks are compared as sets: the order of the playlist is kept, and
+    tracks to add are appended in the order of `desired`.
+    """
+
+    current_ids = set(current)
+    desired_ids = set(desired)
+
+    remove = [id_ for id_ in dict.fromkeys(current)
+              if id_ not in desired_ids]
+    add = [id_ for id_ in dict.fromkeys(desired)
+           if id_ not in current_ids]
+
+    return remove, add
+
+
+def get_snapshot_id(playlist_id):
+    return get(api_url('playlists/' + playlist_id),
+               {'fields': 'snapshot_id'})['snapshot_id']
+
+
+def sync_playlist(playlist_id, desired, workers=8, snapshot_id=None):
+    """
+    Make the playlist `playlist_id` hold the tracks `desired`, with as few
+    requests as possible.
+
+    The current tracks are fetched and compared with `desired`; only the
+    difference is removed and added, `MAX_URIS` tracks per request. Every
+    request passes on the `snapshot_id` returned by the one before, so the
+    removals apply to the version of the playlist that was compared.
+    Adding tracks isn't idempotent, so it isn't retried after a server error
+    or a read timeout; the sync fails instead, and the next one compares
+    again.
+
+    :param playlist_id: The playlist to change.
+    :param desired: List of track ids.
+    :param workers: How many pages of the current tracks to fetch at once.
+    :param snapshot_id: The playlist's current `snapshot_id`, if known.
+    :return: Dictionary with the playlist's new `snapshot_id` and the
+             number of tracks `removed` and `added`.
+    """
+
+    url = api_url('playlists/{}/tracks'.format(playlist_id))
+
+    if snapshot_id is None:
+        snapshot_id = get_snapshot_id(playlist_id)
+
+    remove, add = playlist_diff(get_playlist_track_ids(url, workers),
+                                desired)
+
+    for group in chunked(remove, MAX_URIS):
+        snapshot_id = delete(url, {'tracks': [{'uri': track_uri(id_)}
+                                              for id_ in group],
+                                   'snapshot_id': snapshot_id}
+                             )['snapshot_id']
+
+    for group in chunked(add, MAX_URIS):
+        snapshot_id = post(url, {'uris': [track_uri(id_) for id_ in group]}
+                           )['snapshot_id']
+
+    return {'snapshot_id': snapshot_id,
+            'removed': len(remove),
+            'added': len(add),
+            }
+
+
+def sync_playlists(desired_by_playlist, saved=None):
+    """
+    Sync several playlists at once, up to `spotify_cfg.playlist_workers`
+    at a time.
+
+    A playlist is skipped without fetching its tracks when its `snapshot_id`
+    is still the one a previous sync left it at, and its desired tracks
+    haven't changed since.
+
+    :param desired_by_playlist: Dictionary of playlist id to list of track
+                                ids.
+    :param saved: The state returned by the previous sync, if any.
+    :return: Dictionary of playlist id to its sync state, to pass as `saved`
+             next time.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from hashlib import sha256
+    from configs import spotify_cfg
+
+    cfg = spotify_cfg()
+    page_workers = nested_page_workers(cfg.playlist_workers)
+    saved = saved or {}
+
+    def sync(item):
+        playlist_id, desired = item
+        tracks = ','.join(sorted(set(desired)))
+        tracks_hash = sha256(tracks.encode()).hexdigest()
+        previous = saved.get(playlist_id, {})
+        snapshot_id = get_snapshot_id(playlist_id)
+
+        if (previous.get('tracks_hash') == tracks_hash
+                and previous.get('snapshot_id') == snapshot_id):
+            return dict(previous, removed=0, added=0)
+
+        result = sync_playlist(playlist_id,
+                               desired,
+                               page_workers,
+                               snapshot_id)
+
+        return dict(result, tracks_hash=tracks_hash)
+
+    with ThreadPoolExecutor(max_workers=cfg.playlist_workers) as executor:
+        items = list(desired_by_playlist.items())
+        results = executor.map(sync, items)
+
+        return {playlist_id: result
+                for (playlist_id, _), result in zip(items, results)}
@@ -1,11 +1,15 @@
 #! /usr/bin/env python3
 
+import datetime
 from collections import OrderedDict
 from luigi.contrib import postgres
 from luigi.parameter import Parameter, ListParameter, DictParameter
-from luigi.parameter import TaskParameter
+from luigi.parameter import TaskParameter, BoolParameter, IntParameter
+from luigi.parameter import DateParameter
 from luigi import Task
-from numpy import nan
+from luigi.task import flatten
+from artifact_store import file_digest
+from instrumentation import record_table_load
 
 
 class HashableDict(OrderedDict):
@@ -13,6 +17,54 @@ class HashableDict(OrderedDict):
         return hash(frozenset(self))
 
 
+def copy_text(df, sep='\t', null='\\N'):
+    """
+    Serialize a DataFrame to PostGreSQL's COPY text format in one pass per
+    column.
+
+    Missing values become `null`, booleans become `t`/`f`, and backslashes,
+    tabs, newlines and carriage returns in text columns are escaped.
+
+    :return: The rows as a single string, one line per row.
+    """
+    from pandas import CategoricalDtype
+    from pandas.api.types import is_bool_dtype, is_numeric_dtype
+
+    def escape(text):
+        return (text.str.replace('\\', '\\\\', regex=False)
+                    .str.replace('\t', '\\t', regex=False)
+                    .str.replace('\n', '\\n', regex=False)
+                    .str.replace('\r', '\\r', regex=False))
+
+    if df.empty:
+        return ''
+
+    df = df.reset_index(drop=True)
+    columns = []
+
+    for name in df.columns:
+        column = df[name]
+        nulls = column.isna()
+
+        if is_bool_dtype(column):
+            text = column.map({True: 't', False: 'f'})
+        elif isinstance(column.dtype, CategoricalDtype):
+            # escape each distinct value once, rather than once per row
+            categories = column.cat.categories.astype(str).to_series()
+            text = column.cat.rename_categories(escape(categories).tolist())
+            text = text.astype(object)
+        elif is_numeric_dtype(column):
+            text = column.astype(str)
+        else:
+            text = escape(column.astype(str))
+
+        columns.append(text.where(~nulls, null))
+
+    lines = columns[0].str.cat(columns[1:], sep=sep)
+
+    return '\n'.join(lines) + '\n'
+
+
 class PostgresTable(postgres.CopyToTable):
     from configs import postgres_cfg_music
 
@@ -24,6 +76,21 @@ class PostgresTable(postgres.CopyToTable):
     database = pg_cfg.database
 
 
+def read_connection():
+    """
+    Connect to the music database as the read-only user.
+    """
+    import psycopg2
+
+    pg_cfg = PostgresTable.pg_cfg
+
+    return psycopg2.connect(host=pg_cfg.host,
+                            port=pg_cfg.port,
+                            database=pg_cfg.database,
+                            user=pg_cfg.read_user,
+                            password=pg_cfg.read_password)
+
+
 class TransactionFactTable(PostgresTable):
     """
     Copy a pandas DataFrame in a transaction fact table fashion to PostGreSQL.
@@ -32,11 +99,19 @@ class TransactionFactTable(PostgresTable):
     :param columns: The columns, in order they show up in the PostGreSQL table.
     :param fn: The Task that provides the data to load.
     :param id_cols: The columns to be used to identify whether a row is already
-                    in the table.
+                    in the table. Rows are compared on all of them together.
     :param merge_cols: The columns representing dimension tables. In a
                        dictionary format, with the key being the `left` to
                        merge with, and the value being a tuple of
-                       (`table`, `right`).
+                       (`table`, `right`, `column`, `insert`). The frame
+                       holds the natural key `left`; it's looked up in
+                       `table`'s `right` column, and `table`'s integer
+                       surrogate key `int_id` is loaded into `column`
+                       instead. If `insert` is true, keys that `table`
+                       doesn't have yet are inserted first, which only works
+                       for lookup tables whose other columns are optional,
+                       like `genres`; otherwise rows whose key isn't in
+                       `table` are left out.
     """
 
     table = Parameter(default='')
@@ -46,55 +121,325 @@ class TransactionFactTable(PostgresTable):
     merge_cols = DictParameter(default={})
 
     column_separator = '\t'
-    null_values = (None, nan)
 
     def requires(self):
         return self.clone(self.fn)
 
-    def rows(self):
-        from pandas import read_pickle, DataFrame
+    def input_digest(self):
+        """
+        Return a digest of the input files, or `None` if one is missing.
+        """
+        from hashlib import sha256
+
+        digest = sha256()
+
+        for target in flatten(self.input()):
+            if not target.exists():
+                return None
+
+            digest.update(file_digest(target.path).encode())
+
+        return digest.hexdigest()
+
+    @property
+    def update_id(self):
+        """
+        Mark the load of one particular input rather than of the Task, so
+        that every new output of `fn`, such as each incremental delta, is
+        loaded once, and an unchanged one isn't loaded again.
+        """
+
+        return '{}_{}'.format(self.task_id, self.input_digest())
+
+    def complete(self):
+        # without its input there's nothing to compare the marker with
+        return self.input_digest() is not None and super().complete()
+
+    def read_frame(self):
+        from intermediates import read_frame
+
+        return read_frame(self.input(), columns=self.frame_columns())
+
+    def dimensions(self):
+        """
+        Return a tuple of (`alias`, `left`, `table`, `right`, `column`) for
+        each of the `merge_cols`.
+        """
+
+        return [('d%d' % i, left, table, right, column)
+                for i, (left, (table, right, column, _))
+                in enumerate(self.merge_cols.items())]
+
+    def frame_columns(self):
+        """
+        The columns of the frame: `columns`, with the natural key `left` in
+        place of each surrogate key `column` of the `merge_cols`.
+        """
+
+        lefts = {column: left
+                 for _, left, _, _, column in self.dimensions()}
+
+        return [lefts.get(column, column) for column in self.columns]
+
+    def copy_columns(self):
+        return self.frame_columns()
+
+    def stage(self, cursor, df):
+        """
+        COPY `df` into an empty temporary table shaped like the target table,
+        dropped when the transaction ends.
+
+        :return: The name of the staging table.
+        """
+        from io import StringIO
+
+        stage_table = 'stage_' + self.table
+
+        # natural keys take their type from the dimension tables
+        sources = {left: '{}.{}'.format(alias, right)
+                   for alias, left, _, right, _ in self.dimensions()}
+        columns = ', '.join('{} AS {}'.format(sources.get(column,
+                                                          't.' + column),
+                                              column)
+                            for column in self.copy_columns())
+        joins = ''.join(' CROSS JOIN {} {}'.format(table, alias)
+                        for alias, _, table, _, _ in self.dimensions())
+
+        cursor.execute("""CREATE TEMP TABLE %s ON COMMIT DROP AS
+                          SELECT %s FROM %s t%s WITH NO DATA;"""
+                       % (stage_table, columns, self.table, joins))
+
+        buffer = StringIO(copy_text(df, sep=self.column_separator))
+        self.copy(cursor, buffer, stage_table)
+
+        return stage_table
+
+    def stage_and_write(self, cursor, df, write):
+        """
+        Stage `df`, then call `write(cursor, stage_table)` to apply it to the
+        table, and record the rows staged and written and the COPY duration.
+        """
+        from time import perf_counter
+
+        started = perf_counter()
+        stage_table = self.stage(cursor, df)
+        copy_seconds = perf_counter() - started
+
+        write(cursor, stage_table)
+        record_table_load(self.table, len(df), cursor.rowcount, copy_seconds)
+
+    def copy(self, cursor, file, table=None):
+        sql = """COPY %s (%s) FROM STDIN;""" % (table or self.table,
+                                                ', '.join(self.copy_columns()))
+
+        cursor.copy_expert(sql, file)
+
+    def insert_dimension_keys(self, cursor, stage_table):
+        """
+        Insert the staged natural keys that are missing from the dimension
+        tables of `merge_cols` marked with `insert`, in a fixed order so that
+        concurrent loads don't deadlock.
+        """
+
+        for left, (table, right, _, insert) in self.merge_cols.items():
+            if not insert:
+                continue
+
+            cursor.execute("""INSERT INTO %s (%s)
+                              SELECT DISTINCT s.%s
+                              FROM %s s
+                              WHERE s.%s IS NOT NULL
+                                AND NOT EXISTS (SELECT 1 FROM %s d
+                                                WHERE d.%s = s.%s)
+                              ORDER BY s.%s
+                              ON CONFLICT DO NOTHING;"""
+                           % (table, right,
+                              left,
+                              stage_table,
+                              left,
+                              table,
+                              right, left,
+                              left))
+
+    def insert_new_rows(self, cursor, stage_table):
+        """
+        Insert the staged rows whose `id_cols` aren't in the table yet, with
+        a single anti-join on the server. Natural keys of the `merge_cols`
+        are translated to surrogate keys with one join per dimension table.
+        """
+
+        self.insert_dimension_keys(cursor, stage_table)
+
+        keys = {column: alias + '.int_id'
+                for alias, _, _, _, column in self.dimensions()}
+        values = {column: keys.get(column, 's.' + column)
+                  for column in self.columns}
+
+        columns = ', '.join(values[column] for column in self.columns)
+        id_cols = ', '.join(values[column] for column in self.id_cols)
+        matches = ' AND '.join('t.{} = {}'.format(column, values[column])
+                               for column in self.id_cols)
+        joins = ''.join(' JOIN {0} {1} ON {1}.{2} = s.{3}'
+                        .format(table, alias, right, left)
+                        for alias, left, table, right, _
+                        in self.dimensions())
+
+        cursor.execute("""INSERT INTO %s (%s)
+                          SELECT DISTINCT ON (%s) %s
+                          FROM %s s%s
+                          WHERE NOT EXISTS (SELECT 1 FROM %s t WHERE %s)
+                          ON CONFLICT DO NOTHING;"""
+                       % (self.table, ', '.join(self.columns),
+                          id_cols, columns,
+                          stage_table, joins,
+                          self.table, matches))
+
+    def load(self, connection):
+        self.stage_and_write(connection.cursor(),
+                             self.read_frame(),
+                             self.insert_new_rows)
+
+    def run(self):
+        """
+        Stage the whole frame with one vectorized COPY and let PostGreSQL
+        insert the rows that are new, instead of pulling every existing id to
+        compare in pandas.
+        """
 
         connection = self.output().connect()
-        cursor = connection.cursor()
 
-        sql = """SELECT %s FROM %s;""" % (', '.join(self.id_cols),
-                                          self.table)
+        self.init_copy(connection)
+        self.load(connection)
+        self.post_copy(connection)
+
+        # mark as complete in same transaction
+        self.output().touch(connection)
+
+        connection.commit()
+        connection.close()
 
-        cursor.execute(sql)
-        results = cursor.fetchall()
 
-        current_df = DataFrame(results, columns=self.id_cols)
+class UpsertDimensionTable(TransactionFactTable):
+    """
+    Copy a pandas DataFrame to a PostGreSQL dimension table, inserting new
+    rows and updating the ones that changed.
+
+    Every row gets a 64-bit content hash of its `columns`, stored in
+    `hash_col`. Rows whose hash matches the stored one are dropped before the
+    upsert, so reloading an unchanged library only costs the staging COPY;
+    the rest are applied in one `INSERT ... ON CONFLICT DO UPDATE`. The
+    `id_cols` need a primary key or unique constraint.
+
+    Takes the same parameters as `TransactionFactTable`.
+    """
 
-        with self.input().open('r') as f:
-            df = read_pickle(f, compression=None)
+    hash_col = 'row_hash'
 
-        if not df.empty:
-            # self.id_cols is tuple for some reason, so we need to convert
-            # to list first
-            # also, .isin compares by index as well as columns if passed a DF
-            # to avoid that we can pass the dict with orient='list' and compare
-            # just the columns
-            df = df[~(df[list(self.id_cols)]
-                      .isin(current_df.to_dict(orient='list'))
-                      .all(axis=1))]
-            df = df[list(self.columns)]
+    def read_frame(self):
+        from pandas.util import hash_pandas_object
 
-        for index, line in df.iterrows():  # returns (index, Series) tuple
-            yield line.values.tolist()
+        df = super().read_frame()
+        row_hash = hash_pandas_object(df, index=False).to_numpy()
+
+        return df.assign(**{self.hash_col: row_hash.view('int64')})
+
+    def copy_columns(self):
+        return list(self.columns) + [self.hash_col]
+
+    def upsert_rows(self, cursor, stage_table):
+        columns = self.copy_columns()
+        id_cols = ', '.join(self.id_cols)
+        unchanged = ' AND '.join('t.{0} = s.{0}'.format(column)
+                                 for column in [*self.id_cols, self.hash_col])
+        updates = ', '.join('{0} = EXCLUDED.{0}'.format(column)
+                            for column in columns
+                            if column not in self.id_cols)
+
+        cursor.execute("""INSERT INTO %s AS t (%s)
+                          SELECT DISTINCT ON (%s) %s
+                          FROM %s s
+                          WHERE NOT EXISTS (SELECT 1 FROM %s t WHERE %s)
+                          ON CONFLICT (%s) DO UPDATE SET %s
+                          WHERE t.%s IS DISTINCT FROM EXCLUDED.%s;"""
+                       % (self.table, ', '.join(columns),
+                          id_cols, ', '.join(columns),
+                          stage_table,
+                          self.table, unchanged,
+                          id_cols, updates,
+                          self.hash_col, self.hash_col))
+
+    def load(self, connection):
+        self.stage_and_write(connection.cursor(),
+                             self.read_frame(),
+                             self.upsert_rows)
+
+
+def table_dependencies(tables):
+    """
+    Read the foreign keys between `tables` from their `table-sql` definitions.
+
+    :return: Dictionary of table to the set of tables it references.
+    """
+    import os
+    import re
+
+    sql_dir = os.path.join(os.path.dirname(__file__), 'table-sql')
+    dependencies = {}
+
+    for table in tables:
+        with open(os.path.join(sql_dir, table + '.sql')) as f:
+            referenced = re.findall(r'references\s+(\w+)', f.read(), re.I)
+
+        dependencies[table] = set(referenced) & set(tables) - {table}
+
+    return dependencies
+
+
+def load_order(jobs):
+    """
+    Group `jobs` into levels that can be loaded one after the other, such that
+    every table is loaded after the tables it references. Jobs within a level
+    don't depend on each other.
+    """
+
+    dependencies = table_dependencies([job['table'] for job in jobs])
+    loaded = set()
+    levels = []
+
+    while len(loaded) < len(jobs):
+        level = [job for job in jobs
+                 if job['table'] not in loaded
+                 and dependencies[job['table']] <= loaded]
+
+        if not level:
+            raise ValueError('Circular foreign keys between tables: {}'
+                             .format(sorted(set(dependencies) - loaded)))
+
+        levels.append(level)
+        loaded.update(job['table'] for job in level)
+
+    return levels
 
 
 class CopyWrapper(Task):
     """
-    Dynamically require each Task in the `jobs` list and remove all local
-    outputs.
+    Require the data Task of each job in the `jobs` list, load every table,
+    and remove all local outputs, once per `date`.
 
     In order to write to multiple tables, we need to pass in a different
     `table` parameter each time. Using the `jobs` list, we can pass in a `dict`
-    that has the appropriate parameters for each requirement.
+    that has the appropriate parameters for each table Task.
+
+    Tables are loaded in foreign key order, as declared in `table-sql`: tables
+    that don't depend on each other are loaded concurrently, each in its own
+    transaction, over up to `load_workers` connections. With `atomic`, all
+    tables are instead loaded in one transaction with deferred constraints,
+    so either every table is loaded or none is.
 
     :param jobs: List of dictionaries. Each dictionary specifies one Task to
                  run and copy to a PostGreSQL table. Necessary keys are:
 
+                 - `table_type`: The table Task, e.g. `TransactionFactTable`.
                  - `table`: The PostGreSQL table.
                  - `fn`: The Task to run in order to get the data.
                  - `columns: The table's columns, in the order they show up in
@@ -106,26 +451,141 @@ class CopyWrapper(Task):
                  - `merge_cols`: The columns that should represent dimension
                                  tables. This should be in the form of a
                                  `HashableDict()`, with the `left` column name
-                                 as key, and a tuple of (`table`, `right`) as
-                                 value.
+                                 as key, and a tuple of (`table`, `right`,
+                                 `column`, `insert`) as value; see
+                                 `TransactionFactTable`.
+    :param date: The day of the load. Each day fetches the data again and
+                 loads what's new; tables whose data didn't change are
+                 skipped, as their markers are tied to the data they loaded
+                 (see `TransactionFactTable.update_id`).
+    :param atomic: Load all tables in a single transaction.
+    :param load_workers: How many tables may be loaded at the same time.
     """
 
     jobs = []
 
+    date = DateParameter(default=datetime.date.today())
+
+    atomic = BoolParameter(default=False, significant=False)
+    load_workers = IntParameter(default=4, significant=False)
+
+    def table_task(self, job):
+        return self.clone(job['table_type'],
+                          table=job['table'],
+                          fn=job['fn'],
+                          columns=job['columns'],
+                          id_cols=job['id_cols'],
+                          merge_cols=job['merge_cols'])
+
     def requires(self):
-        for job in self.jobs:
-            self.table = job['table']
-            self.fn = job['fn']
-            self.columns = job['columns']
-            self.id_cols = job['id_cols']
-            self.date_cols = job['date_cols']
-            self.merge_cols = job['merge_cols']
-            yield self.clone(job['table_type'])
+        return [self.table_task(job).requires() for job in self.jobs]
+
+    def output(self):
+        pg_cfg = PostgresTable.pg_cfg
+
+        return postgres.PostgresTarget(host=pg_cfg.host,
+                                       port=pg_cfg.port,
+                                       database=pg_cfg.database,
+                                       user=pg_cfg.user,
+                                       password=pg_cfg.password,
+                                       table=self.task_family,
+                                       update_id=self.task_id)
+
+    def load_table(self, task, connection):
+        task.init_copy(connection)
+        task.load(connection)
+        task.post_copy(connection)
+
+        # mark as complete in same transaction
+        task.output().touch(connection)
+
+    def load_atomically(self, levels):
+        tasks = [self.table_task(job) for level in levels for job in level]
+        connection = tasks[0].output().connect()
+
+        try:
+            connection.cursor().execute("""SET CONSTRAINTS ALL DEFERRED;""")
+
+            for task in tasks:
+                if not task.complete():
+                    self.load_table(task, connection)
+
+            connection.commit()
+        finally:
+            connection.close()
+
+    def load_concurrently(self, levels):
+        from concurrent.futures import ThreadPoolExecutor
+        from psycopg2.pool import ThreadedConnectionPool
+
+        pg_cfg = PostgresTable.pg_cfg
+        pool = ThreadedConnectionPool(1,
+                                      self.load_workers,
+                                      host=pg_cfg.host,
+                                      port=pg_cfg.port,
+                                      database=pg_cfg.database,
+                                      user=pg_cfg.user,
+                                      password=pg_cfg.password)
+
+        def load(task):
+            connection = pool.getconn()
+            connection.set_client_encoding('utf-8')
+
+            try:
+                self.load_table(task, connection)
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                raise
+            finally:
+                pool.putconn(connection)
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.load_workers) as executor:
+                for level in levels:
+                    tasks = [self.table_task(job) for job in level]
+                    tasks = [task for task in tasks if not task.complete()]
+
+                    # surfaces the first exception before the next level
+                    list(executor.map(load, tasks))
+        finally:
+            pool.closeall()
+
+    def load_tables(self):
+        levels = load_order(self.jobs)
+
+        # create the marker table up front, rather than in concurrent touches
+        self.table_task(self.jobs[0]).output().create_marker_table()
+
+        if self.atomic:
+            self.load_atomically(levels)
+        else:
+            self.load_concurrently(levels)
+
+    def after_load(self):
+        """
+        Hook for subclasses, called once every table has been loaded and
+        before the local outputs are removed.
+        """
+        pass
+
+    def loaded(self, table):
+        """
+        Whether `table` holds the current output of its data Task, i.e.
+        whether this run loaded it, or an earlier one loaded the same data.
+        """
+
+        job = next(job for job in self.jobs if job['table'] == table)
+
+        return self.table_task(job).complete()
 
     def run(self):
         import os
         import shutil
 
+        self.load_tables()
+        self.after_load()
+
         filepath = os.path.expanduser('~/Temp/luigi')
 
         for file in os.listdir(filepath):
@@ -135,15 +595,10 @@ class CopyWrapper(Task):
             elif os.path.isdir(full_path):
                 shutil.rmtree(full_path)
 
-    def complete(self):
-        import os
-
-        filepath = os.path.expanduser('~/Temp/luigi')
-
-        if not os.path.exists(filepath):
-            return False
-
-        existing_files = os.listdir(filepath)
-        finished_tasks = [inp.exists() for inp in self.input()]
+        connection = self.output().connect()
 
-        return (existing_files == []) and (any(finished_tasks))
+        try:
+            self.output().touch(connection)
+            connection.commit()
+        finally:
+            connection.close()
@@ -0,0 +1,210 @@
+#! /usr/bin/env python3
+
+import numpy as np
+
+# audio features of the `tracks` table and their default weights; `key` and
+# `time_signature` are categorical, so they don't count unless asked for
+FEATURE_WEIGHTS = {'acousticness': 1.0,
+                   'danceability': 1.0,
+                   'energy': 1.0,
+                   'instrumentalness': 1.0,
+                   'key': 0.0,
+                   'liveness': 0.5,
+                   'loudness': 0.5,
+                   'mode': 0.5,
+                   'speechiness': 1.0,
+                   'tempo': 0.5,
+                   'time_signature': 0.0,
+                   'valence': 1.0,
+                   }
+
+
+class TrackSimilarity:
+    """
+    Nearest-neighbour search over the audio features of tracks.
+
+    Every feature is standardized to zero mean and unit variance (missing
+    values become the mean) and scaled by the square root of its weight, so
+    that squared Euclidean distances between rows of the float32 `matrix` are
+    weighted sums of squared feature differences. Queries are answered with
+    one matrix product per chunk of query vectors and `argpartition`, without
+    an index to build or keep up to date.
+
+    :param ids: The track ids, one per row of `features`.
+    :param features: DataFrame with one column per feature in `weights`.
+    :param weights: Dictionary of feature to weight. Features with weight 0
+                    are left out.
+    :param normalization: Optional `normalization()` of an earlier instance,
+                          to place the tracks in the same space instead of
+                          standardizing them on their own statistics.
+    """
+
+    def __init__(self, ids, features, weights=None, normalization=None):
+        self.ids = np.asarray(ids)
+        self.positions = {id_: i for i, id_ in enumerate(self.ids)}
+
+        if normalization is None:
+            weights = {feature: weight
+                       for feature, weight
+                       in (weights or FEATURE_WEIGHTS).items()
+                       if weight > 0}
+
+            self.features = list(weights)
+            values = features[self.features].to_numpy(dtype='float64',
+                                                      na_value=np.nan)
+            self.mean = np.nanmean(values, axis=0)
+            self.std = np.nanstd(values, axis=0)
+            self.std[~(self.std > 0)] = 1
+            self.scale = np.sqrt([weights[feature]
+                                  for feature in self.features])
+        else:
+            self.features = list(normalization['features'])
+            values = features[self.features].to_numpy(dtype='float64',
+                                                      na_value=np.nan)
+            self.mean = np.asarray(normalization['mean'])
+            self.std = np.asarray(normalization['std'])
+            self.scale = np.asarray(normalization['scale'])
+
+        self.matrix = self.transform(values)
+        self.norms = np.einsum('ij,ij->i', self.matrix, self.matrix)
+
+    @classmethod
+    def from_frame(cls, tracks, weights=None, normalization=None):
+        """
+        Build from a frame with an `id` column and the feature columns, such
+        as the output of `MergeTracks`.
+        """
+
+        return cls(tracks['id'], tracks, weights, normalization)
+
+    @classmethod
+    def from_database(cls, weights=None):
+        """
+        Build from the `tracks` table, read in one query.
+        """
+        from pandas import DataFrame
+        from postgres_templates import read_connection
+
+        features = [feature for feature in FEATURE_WEIGHTS
+                    if (weights or FEATURE_WEIGHTS).get(feature, 0) > 0]
+
+        connection = read_connection()
+
+        try:
+            cursor = connection.cursor()
+            cursor.execute("""SELECT id, %s FROM tracks ORDER BY id;"""
+                           % ', '.join(features))
+            tracks = DataFrame(cursor.fetchall(), columns=['id', *features])
+        finally:
+            connection.close()
+
+        return cls.from_frame(tracks, weights)
+
+    def normalization(self):
+        """
+        Return the features, means, standard deviations and weight scales
+        the matrix was built with, as a dictionary of arrays.
+        """
+
+        return {'features': np.asarray(self.features),
+                'mean': self.mean,
+                'std': self.std,
+                'scale': self.scale,
+                }
+
+    def transform(self, values):
+        """
+        Standardize and weight a 2-D array of raw feature values.
+        """
+
+        values = (np.asarray(values, dtype='float64') - self.mean) / self.std
+        values = np.nan_to_num(values, nan=0.0) * self.scale
+
+        return values.astype('float32')
+
+    def vectors(self, ids):
+        return self.matrix[[self.positions[id_] for id_ in ids]]
+
+    def knn(self, queries, k=20, exclude=None, chunk_size=1024):
+        """
+        Find the `k` nearest tracks of each query vector.
+
+        :param queries: 2-D array of transformed query vectors.
+        :param k: Number of neighbours per query.
+        :param exclude: Optional list, per query, of row positions that may
+                        not be returned, e.g. the seeds themselves.
+        :param chunk_size: Number of queries whose distances to every track
+                           are held in memory at once.
+        :return: Tuple of (row positions, squared distances), both of shape
+                 `(len(queries), k)`, nearest first.
+        """
+
+        queries = np.asarray(queries, dtype='float32')
+        k = min(k, len(self.ids))
+        positions = np.empty((len(queries), k), dtype='int64')
+        distances = np.empty((len(queries), k), dtype='float32')
+
+        for start in range(0, len(queries), chunk_size):
+            chunk = queries[start:start + chunk_size]
+
+            # |a - b|^2 = |a|^2 - 2 a.b + |b|^2, as one matrix product
+            squared = (self.norms[None, :]
+                       - 2 * chunk @ self.matrix.T
+                       + np.einsum('ij,ij->i', chunk, chunk)[:, None])
+
+            if exclude is not None:
+                for row, excluded in enumerate(exclude[start:start
+                                                       + chunk_size]):
+                    squared[row, list(excluded)] = np.inf
+
+            nearest = np.argpartition(squared, k - 1, axis=1)[:, :k]
+            nearest_distances = np.take_along_axis(squared, nearest, axis=1)
+            order = np.argsort(nearest_distances, axis=1)
+
+            stop = start + len(chunk)
+            positions[start:stop] = np.take_along_axis(nearest, order, axis=1)
+            distances[start:stop] = np.take_along_axis(nearest_distances,
+                                                       order,
+                                                       axis=1)
+
+        return positions, np.maximum(distances, 0)
+
+    def similar(self, seed_ids, k=20):
+        """
+        Rank the tracks closest to the centre of `seed_ids`, leaving out the
+        seeds.
+
+        :return: DataFrame of `id` and `distance`, nearest first.
+        """
+        from pandas import DataFrame
+
+        seeds = [self.positions[id_] for id_ in seed_ids]
+        query = self.matrix[seeds].mean(axis=0, keepdims=True)
+
+        positions, distances = self.knn(query, k, exclude=[seeds])
+        found = np.isfinite(distances[0])
+
+        return DataFrame({'id': self.ids[positions[0][found]],
+                          'distance': np.sqrt(distances[0][found])})
+
+    def similar_to_each(self, seed_ids, k=20):
+        """
+        Rank the `k` tracks closest to each of `seed_ids` in one batch.
+
+        :return: DataFrame of `seed_id`, `rank`, `id` and `distance`.
+        """
+        from pandas import DataFrame
+
+        seeds = [self.positions[id_] for id_ in seed_ids]
+        positions, distances = self.knn(self.matrix[seeds],
+                                        k,
+                                        exclude=[[seed] for seed in seeds])
+        found = np.isfinite(distances).ravel()
+
+        return DataFrame({
+            'seed_id': np.repeat(np.asarray(seed_ids), positions.shape[1]),
+            'rank': np.tile(np.arange(1, positions.shape[1] + 1),
+                            len(seeds)),
+            'id': self.ids[positions.ravel()],
+            'distance': np.sqrt(distances.ravel()),
+        })[found]
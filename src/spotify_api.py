@@ -4,9 +4,69 @@ import requests
 from os import path
 from datetime import datetime
 import configparser
+from contextlib import contextmanager
+from time import monotonic, sleep
+
+
+def secrets_path():
+    basepath = path.dirname(__file__)
+    return path.abspath(path.join(basepath, '..', 'secrets.cfg'))
+
+
+def utc_timestamp():
+    return int(datetime.utcnow().strftime('%s'))
+
+
+@contextmanager
+def secrets_lock():
+    """
+    Hold an exclusive lock on `secrets.cfg` across processes.
+
+    The lock lives in a separate `secrets.cfg.lock` file so that the secrets
+    file itself can be replaced atomically while the lock is held.
+    """
+    import fcntl
+
+    with open(secrets_path() + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def write_secrets(config):
+    """
+    Atomically replace `secrets.cfg` with `config`, so that readers never see
+    a partially written file.
+    """
+    import os
+    from tempfile import NamedTemporaryFile
+
+    filepath = secrets_path()
+
+    with NamedTemporaryFile('w',
+                            dir=path.dirname(filepath),
+                            prefix='.secrets.cfg.',
+                            delete=False) as f:
+        config.write(f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.chmod(f.name, 0o600)
+    os.replace(f.name, filepath)
 
 
 def refresh_access_token(client_id, client_secret, refresh_token):
+    """
+    Exchange `refresh_token` for a new access token and store both in
+    `secrets.cfg`. Callers should hold `secrets_lock()`, otherwise concurrent
+    refreshes can overwrite each other's refresh token. As every worker
+    waits on that lock, the request gives up after `spotify_cfg.timeout`
+    seconds.
+    """
+    from configs import spotify_cfg
+
     auth_token_url = 'https://accounts.spotify.com/api/token'
 
     payload = {'client_id': client_id,
@@ -15,7 +75,9 @@ def refresh_access_token(client_id, client_secret, refresh_token):
                'grant_type': 'refresh_token',
                }
 
-    r = requests.post(auth_token_url, data=payload)
+    r = requests.post(auth_token_url,
+                      data=payload,
+                      timeout=spotify_cfg().timeout)
 
     if r.status_code == 200:
         tokens = r.json()
@@ -25,44 +87,250 @@ def refresh_access_token(client_id, client_secret, refresh_token):
         ts = datetime.strptime(r.headers['date'],
                                '%a, %d %b %Y %X %Z').strftime('%s')
 
-        basepath = path.dirname(__file__)
-        filepath = path.abspath(path.join(basepath, '..', 'secrets.cfg'))
-
         config = configparser.ConfigParser()
-        config.read(filepath)
-
-        # here there might be concurrency issues if there are ever multiple
-        # workers involved...
+        config.read(secrets_path())
 
         config['spotify_secrets']['SPOTIFY_ACCESS_TOKEN'] = access_token
         config['spotify_secrets']['SPOTIFY_REFRESH_TOKEN'] = refresh_token
         config['spotify_secrets']['SPOTIFY_REFRESH_TIME'] = ts
 
-        with open(filepath, 'w') as f:
-            config.write(f)
+        write_secrets(config)
     else:
         raise requests.HTTPError('Error: response: {}'.format(r.text))
 
     return access_token
 
 
+class TokenProvider:
+    """
+    Hand out a valid access token, keeping it and its expiry in memory.
+
+    `secrets.cfg` is only read the first time a token is requested; after
+    that the cached token is returned until it is within `margin` seconds of
+    expiring, or until the API rejects it (see `reject`), at which point it
+    is refreshed (which rewrites the file).
+
+    Refreshes are serialized across processes with `secrets_lock()`. Once a
+    process holds the lock it re-reads the file, so if another luigi worker
+    refreshed in the meantime its token is reused instead of requesting a
+    new one.
+
+    :param lifetime: How long, in seconds, an access token is valid for.
+    :param margin: How many seconds ahead of expiry to refresh the token.
+    """
+
+    def __init__(self, lifetime=3600, margin=300):
+        from threading import Lock
+
+        self.lifetime = lifetime
+        self.margin = margin
+        self.access_token = None
+        self.expires_at = 0
+        self.rejected = None
+        self._lock = Lock()
+
+    def _is_fresh(self):
+        return (self.access_token != self.rejected
+                and utc_timestamp() < self.expires_at - self.margin)
+
+    def _load(self):
+        config = configparser.ConfigParser()
+        config.read(secrets_path())
+
+        self.secrets = config['spotify_secrets']
+        self.access_token = self.secrets['SPOTIFY_ACCESS_TOKEN']
+        self.expires_at = (int(self.secrets['SPOTIFY_REFRESH_TIME'])
+                           + self.lifetime)
+
+    def get(self):
+        if self.access_token is not None and self._is_fresh():
+            return self.access_token
+
+        with self._lock:
+            if self.access_token is None:
+                self._load()
+
+            if not self._is_fresh():
+                with secrets_lock():
+                    self._load()
+
+                    if not self._is_fresh():
+                        refresh_access_token(
+                            self.secrets['client_id'],
+                            self.secrets['client_secret'],
+                            self.secrets['SPOTIFY_REFRESH_TOKEN'])
+                        self._load()
+
+        return self.access_token
+
+    def reject(self, access_token):
+        """
+        Stop handing out `access_token` after the API answered 401 to it, so
+        the next `get` refreshes it, unless another thread or process already
+        has.
+        """
+
+        with self._lock:
+            self.rejected = access_token
+
+
+token_provider = TokenProvider()
+
+
 def check_for_refresh():
+    return token_provider.get()
 
-    basepath = path.dirname(__file__)
-    filepath = path.abspath(path.join(basepath, '..', 'secrets.cfg'))
 
-    config = configparser.ConfigParser()
-    config.read(filepath)
+class RateLimiter:
+    """
+    Request budget and retry policy shared by every request in a process.
 
-    secrets = config['spotify_secrets']
-    access_token = secrets['SPOTIFY_ACCESS_TOKEN']
+    Requests draw from a token bucket that refills at `rate` tokens per second
+    and holds at most `burst` tokens. Responses with status 429 are retried
+    after the number of seconds in their `Retry-After` header, and the whole
+    bucket is paused for that long, so other threads don't keep hitting the
+    limit. Server errors (5xx), connection errors and timeouts are retried
+    with exponential backoff and full jitter. A 401 marks the access token as
+    rejected in `token_provider` and is retried right away, with the
+    refreshed token. Any other error is raised.
 
-    refresh_time = int(secrets['SPOTIFY_REFRESH_TIME'])
-    current_time = int(datetime.utcnow().strftime('%s'))
+    Requests that aren't idempotent, like adding tracks to a playlist, may
+    have been applied when a server error or a timeout comes back, so only
+    the responses that reject them outright (429 and 401) and connection
+    timeouts are retried. Other connection errors are raised.
 
-    if current_time - refresh_time > 3540:
-        access_token = refresh_access_token(secrets['client_id'],
-                                            secrets['client_secret'],
-                                            secrets['SPOTIFY_REFRESH_TOKEN'])
+    `stats` counts requests sent, retries, throttled responses and the total
+    number of seconds spent waiting.
+    """
 
-    return access_token
+    def __init__(self, rate, burst, max_retries, backoff_base, backoff_cap):
+        from collections import Counter
+        from threading import Lock
+
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+
+        self.tokens = burst
+        self.updated_at = monotonic()
+        self.paused_until = 0
+        self.stats = Counter()
+        self._lock = Lock()
+
+    def _wait(self, seconds):
+        sleep(seconds)
+        with self._lock:
+            self.stats['wait_seconds'] += seconds
+
+    def acquire(self):
+        """
+        Block until a request may be sent.
+        """
+
+        while True:
+            with self._lock:
+                now = monotonic()
+                self.tokens = min(self.burst,
+                                  self.tokens
+                                  + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    delay = (1 - self.tokens) / self.rate
+
+            self._wait(delay)
+
+    def backoff(self, attempt):
+        from random import uniform
+
+        return uniform(0, min(self.backoff_cap,
+                              self.backoff_base * 2 ** attempt))
+
+    def retry_after(self, response, attempt):
+        try:
+            delay = float(response.headers['Retry-After'])
+        except (KeyError, ValueError):
+            delay = self.backoff(attempt)
+
+        with self._lock:
+            self.stats['throttled'] += 1
+            self.paused_until = max(self.paused_until, monotonic() + delay)
+
+        return delay
+
+    def request(self, send, idempotent=True):
+        """
+        Call `send` until it returns a successful response.
+
+        :param send: Callable without arguments that sends the request and
+                     returns a `requests.Response`. It is called again for
+                     each retry, so it should build its headers (and thus
+                     pick up a refreshed access token) every time.
+        :param idempotent: Whether sending the request twice has the same
+                           effect as sending it once.
+        :return: The successful `requests.Response`.
+        """
+        retried_errors = ((requests.ConnectionError, requests.Timeout)
+                          if idempotent else requests.ConnectTimeout)
+
+        for attempt in range(self.max_retries + 1):
+            self.acquire()
+
+            with self._lock:
+                self.stats['requests'] += 1
+
+            try:
+                r = send()
+            except retried_errors:
+                if attempt == self.max_retries:
+                    raise
+
+                r = None
+
+            if r is None or (r.status_code >= 500 and idempotent):
+                delay = self.backoff(attempt)
+            elif r.status_code == 429:
+                delay = self.retry_after(r, attempt)
+            elif r.status_code == 401:
+                authorization = r.request.headers.get('Authorization', '')
+                token_provider.reject(authorization.split(' ')[-1])
+                delay = 0
+            else:
+                break
+
+            if attempt < self.max_retries:
+                with self._lock:
+                    self.stats['retries'] += 1
+                self._wait(delay)
+
+        if not r.ok:
+            print('Error accessing url: {}'.format(r.url))
+            r.raise_for_status()
+
+        return r
+
+
+_rate_limiter = None
+
+
+def get_rate_limiter():
+    from configs import spotify_cfg
+
+    global _rate_limiter
+
+    if _rate_limiter is None:
+        cfg = spotify_cfg()
+        _rate_limiter = RateLimiter(cfg.requests_per_second,
+                                    cfg.burst,
+                                    cfg.max_retries,
+                                    cfg.backoff_base,
+                                    cfg.backoff_cap)
+
+    return _rate_limiter
@@ -0,0 +1,235 @@
+#! /usr/bin/env python3
+
+import os
+import requests
+from requests.adapters import HTTPAdapter
+from spotify_api import check_for_refresh, get_rate_limiter
+from instrumentation import record_request
+
+_session = None
+_session_pid = None
+
+
+def get_session():
+    """
+    Return this process' pooled `requests.Session`.
+
+    The session keeps connections to the API alive between requests, so only
+    the first request to a host pays for the TCP and TLS handshakes. Sessions
+    aren't shared across processes: a luigi worker forked from the scheduler
+    process builds its own.
+    """
+    from configs import spotify_cfg
+
+    global _session, _session_pid
+
+    if _session is None or _session_pid != os.getpid():
+        pool_size = spotify_cfg().pool_size
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+
+        _session = requests.Session()
+        _session.mount('https://', adapter)
+        _session.mount('http://', adapter)
+        _session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+        _session_pid = os.getpid()
+
+    return _session
+
+
+def api_url(endpoint):
+    from configs import spotify_cfg
+
+    return '{}/{}'.format(spotify_cfg().api_url, endpoint.lstrip('/'))
+
+
+def endpoint_name(url):
+    """
+    Name the endpoint of `url` for metrics, with ids replaced by `{id}`, e.g.
+    `playlists/{id}/tracks`.
+    """
+    from configs import spotify_cfg
+    from urllib.parse import urlparse
+
+    base = urlparse(spotify_cfg().api_url).path.strip('/')
+    parts = urlparse(url).path.strip('/')[len(base):].strip('/').split('/')
+
+    if parts[0] == 'me':
+        return '/'.join(parts)
+
+    # collections and ids alternate, e.g. users/{id}/playlists
+    return '/'.join(part if i % 2 == 0 else '{id}'
+                    for i, part in enumerate(parts))
+
+
+def auth_headers():
+    return {'Authorization': 'Bearer {}'.format(check_for_refresh())}
+
+
+def send(method, url, params=None, json=None, idempotent=True):
+    """
+    Send a request to the API through the shared session and rate limiter,
+    and return the decoded response. Each attempt gives up after
+    `spotify_cfg.timeout` seconds without a response. Pass `idempotent=False`
+    for requests that mustn't be sent twice; see `RateLimiter`.
+    """
+    from time import perf_counter
+    from configs import spotify_cfg
+
+    session = get_session()
+    endpoint = endpoint_name(url)
+    timeout = spotify_cfg().timeout
+
+    def attempt():
+        started = perf_counter()
+        r = session.request(method,
+                            url,
+                            params=params,
+                            json=json,
+                            headers=auth_headers(),
+                            timeout=timeout)
+        record_request(endpoint, perf_counter() - started, r)
+
+        return r
+
+    r = get_rate_limiter().request(attempt, idempotent)
+
+    return r.json()
+
+
+def get(url, params=None):
+    return send('GET', url, params)
+
+
+def post(url, json, idempotent=False):
+    return send('POST', url, json=json, idempotent=idempotent)
+
+
+def delete(url, json):
+    return send('DELETE', url, json=json)
+
+
+def get_pages(url, params=None):
+    """
+    Yield each page of a paginated endpoint by following the `next` links.
+    """
+
+    while url is not None:
+        data = get(url, params)
+        yield data
+        url = data['next']
+
+
+def get_pages_by_offset(url, params=None, workers=8):
+    """
+    Yield each page of a paginated endpoint, in order, fetching pages
+    concurrently.
+
+    The first page is fetched on its own to learn `total` and `limit`; the
+    remaining offsets are then requested from a pool of `workers` threads. At
+    most `2 * workers` pages are in flight or waiting to be yielded at any
+    time.
+    """
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+
+    params = dict(params or {})
+
+    first_page = get(url, params)
+    yield first_page
+
+    limit = first_page['limit']
+    offsets = range(first_page['offset'] + limit, first_page['total'], limit)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+
+        for offset in offsets:
+            page_params = dict(params, offset=offset)
+            pending.append(executor.submit(get, url, page_params))
+
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def iter_pages(url, params=None):
+    """
+    Yield each page of a paginated endpoint, in order, using offset
+    pagination when `spotify_cfg.parallel_pages` is set.
+    """
+    from configs import spotify_cfg
+
+    cfg = spotify_cfg()
+
+    if cfg.parallel_pages:
+        return get_pages_by_offset(url, params, cfg.page_workers)
+    else:
+        return get_pages(url, params)
+
+
+def nested_page_workers(outer_workers):
+    """
+    Return how many pages each of `outer_workers` concurrent paginated
+    fetches may request at once, so that together they fit in the
+    `spotify_cfg.pool_size` connections the session keeps alive. Beyond the
+    pool, connections are opened and discarded per request.
+    """
+    from configs import spotify_cfg
+
+    cfg = spotify_cfg()
+
+    return max(1, min(cfg.page_workers, cfg.pool_size // outer_workers))
+
+
+def get_playlist_track_ids(url, workers=8):
+    """
+    Return the ids of the tracks of a playlist, in playlist order, from its
+    `tracks` endpoint. Local files, which have no id, are left out.
+    """
+
+    params = {'limit': 100,
+              'fields': 'items(track(id)),next,total,limit,offset'}
+    pages = get_pages_by_offset(url, params, workers)
+
+    return [x['track']['id'] for data in pages for x in data['items']
+            if x['track'] is not None and x['track']['id'] is not None]
+
+
+def get_items(url, params=None):
+    """
+    Return the `items` of every page of a paginated endpoint.
+    """
+
+    return [item for page in iter_pages(url, params) for item in page['items']]
+
+
+def get_by_ids(url, ids, batch_size, key):
+    """
+    Look up `ids` on a batch endpoint such as `/albums` or `/artists`.
+
+    Batches are requested concurrently, up to `spotify_cfg.batch_workers` at a
+    time.
+
+    :param url: The endpoint to query.
+    :param ids: Iterable of Spotify ids.
+    :param batch_size: The maximum number of ids the endpoint accepts per
+                       request.
+    :param key: The key in the response that holds the list of objects.
+    :return: The objects, in the same order as `ids`.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from configs import spotify_cfg
+    from more_itertools import chunked
+
+    workers = spotify_cfg().batch_workers
+
+    def get_batch(group):
+        return get(url, {'ids': ','.join(group)})[key]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        batches = executor.map(get_batch, chunked(ids, batch_size))
+
+        return [item for batch in batches for item in batch]
@@ -0,0 +1,55 @@
+#! /usr/bin/env python3
+
+import json
+import os
+from os import path
+
+
+def state_path(name):
+    from configs import cache_cfg
+
+    return path.join(path.expanduser(cache_cfg().path), name + '.json')
+
+
+def load_state(name, default=None):
+    """
+    Return the state saved under `name`, or `default` if there is none.
+    """
+
+    try:
+        with open(state_path(name)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+
+def save_state(name, value):
+    """
+    Atomically replace the state saved under `name` with `value`.
+    """
+    from tempfile import NamedTemporaryFile
+
+    filepath = state_path(name)
+    os.makedirs(path.dirname(filepath), exist_ok=True)
+
+    with NamedTemporaryFile('w',
+                            dir=path.dirname(filepath),
+                            prefix='.' + name + '.',
+                            delete=False) as f:
+        json.dump(value, f)
+
+    os.replace(f.name, filepath)
+
+
+def commit_state(name, target):
+    """
+    Save the pending state that a task wrote to `target`.
+
+    Tasks write the state they would like to keep (e.g. a high-water mark) to
+    one of their outputs; the wrapper task calls this once everything has
+    been loaded, so a failed run never advances the saved state.
+    """
+
+    if target.exists():
+        with target.open('r') as f:
+            save_state(name, json.load(f))
@@ -1,4 +1,4 @@
 create table album_genres(
-album_id text references albums(id) not null,
-genre_name text not null
+album_int_id integer references albums(int_id) deferrable not null,
+genre_int_id smallint references genres(int_id) deferrable not null
 );
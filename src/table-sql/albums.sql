@@ -1,5 +1,6 @@
 create table albums(
 id text primary key,
+int_id serial unique not null, --compact key for the tables that reference it
 name text not null,
 uri text unique not null,
 available_in_us boolean not null,
@@ -7,5 +8,6 @@ album_type text not null,
 release_year smallint, --unclear if this is available everywhere
 release_month smallint, --definitely not available everywhere
 release_day smallint, --ditto
-label text
+label text,
+row_hash bigint --hash of the other columns, to skip unchanged rows
 );
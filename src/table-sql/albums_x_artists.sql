@@ -1,4 +1,4 @@
 create table albums_x_artists(
-album_id text references albums(id) not null,
-artist_id text references artists(id) not null
+album_int_id integer references albums(int_id) deferrable not null,
+artist_int_id integer references artists(int_id) deferrable not null
 );
@@ -1,4 +1,4 @@
 create table artist_genres(
-artist_id text references artists(id) not null,
-genre_name text not null
+artist_int_id integer references artists(int_id) deferrable not null,
+genre_int_id smallint references genres(int_id) deferrable not null
 );
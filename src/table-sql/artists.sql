@@ -1,5 +1,7 @@
 create table artists(
 id text primary key,
+int_id serial unique not null, --compact key for the tables that reference it
 name text not null,
-uri text unique not null
+uri text unique not null,
+row_hash bigint --hash of the other columns, to skip unchanged rows
 );
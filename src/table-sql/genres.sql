@@ -0,0 +1,4 @@
+create table genres(
+int_id smallserial primary key,
+genre_name text unique not null
+);
@@ -0,0 +1,8 @@
+--Make the foreign keys of a database created from the original schema
+--deferrable, so that atomic loads can defer them to the commit.
+--Run once, alongside row_hash.sql:
+--    psql -d <database> -1 -f deferrable_keys.sql
+--The keys of the edge and playlist tables are recreated deferrable by
+--integer_keys.sql.
+
+alter table tracks alter constraint tracks_main_artist_fkey deferrable;
@@ -0,0 +1,79 @@
+--Move a database created before the genres table to integer surrogate keys.
+--Run once, after row_hash.sql and before the first load with the new schema:
+--    psql -d <database> -1 -f integer_keys.sql
+--tracks.main_artist and playlists_x_tracks.track_id keep their text ids.
+
+create table genres(
+int_id smallserial primary key,
+genre_name text unique not null
+);
+
+insert into genres (genre_name)
+select genre_name from artist_genres
+union select genre_name from album_genres
+union select genre_name from playlists
+union select genre_name from playlists_x_tracks
+order by 1;
+
+--adding a serial column numbers the existing rows
+alter table artists add column int_id serial unique not null;
+alter table albums add column int_id serial unique not null;
+
+alter table artist_genres
+    add column artist_int_id integer references artists(int_id) deferrable,
+    add column genre_int_id smallint references genres(int_id) deferrable;
+update artist_genres t
+set artist_int_id = a.int_id, genre_int_id = g.int_id
+from artists a, genres g
+where a.id = t.artist_id and g.genre_name = t.genre_name;
+alter table artist_genres
+    drop column artist_id,
+    drop column genre_name,
+    alter column artist_int_id set not null,
+    alter column genre_int_id set not null;
+
+alter table album_genres
+    add column album_int_id integer references albums(int_id) deferrable,
+    add column genre_int_id smallint references genres(int_id) deferrable;
+update album_genres t
+set album_int_id = a.int_id, genre_int_id = g.int_id
+from albums a, genres g
+where a.id = t.album_id and g.genre_name = t.genre_name;
+alter table album_genres
+    drop column album_id,
+    drop column genre_name,
+    alter column album_int_id set not null,
+    alter column genre_int_id set not null;
+
+alter table albums_x_artists
+    add column album_int_id integer references albums(int_id) deferrable,
+    add column artist_int_id integer references artists(int_id) deferrable;
+update albums_x_artists t
+set album_int_id = al.int_id, artist_int_id = ar.int_id
+from albums al, artists ar
+where al.id = t.album_id and ar.id = t.artist_id;
+alter table albums_x_artists
+    drop column album_id,
+    drop column artist_id,
+    alter column album_int_id set not null,
+    alter column artist_int_id set not null;
+
+alter table playlists
+    add column genre_int_id smallint references genres(int_id) deferrable;
+update playlists t
+set genre_int_id = g.int_id
+from genres g
+where g.genre_name = t.genre_name;
+alter table playlists
+    drop column genre_name,
+    alter column genre_int_id set not null;
+
+alter table playlists_x_tracks
+    add column genre_int_id smallint references genres(int_id) deferrable;
+update playlists_x_tracks t
+set genre_int_id = g.int_id
+from genres g
+where g.genre_name = t.genre_name;
+alter table playlists_x_tracks
+    drop column genre_name,
+    alter column genre_int_id set not null;
@@ -0,0 +1,9 @@
+--Add the content hashes the upserts of albums, artists and tracks compare.
+--Run once, before the first load that upserts them, and before
+--integer_keys.sql:
+--    psql -d <database> -1 -f row_hash.sql
+--Existing rows get a null hash, so the next load rewrites each of them once.
+
+alter table albums add column row_hash bigint;
+alter table artists add column row_hash bigint;
+alter table tracks add column row_hash bigint;
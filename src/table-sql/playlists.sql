@@ -1,4 +1,4 @@
 create table playlists(
 playlist_id text not null,
-genre_name text not null
+genre_int_id smallint references genres(int_id) deferrable not null
 );
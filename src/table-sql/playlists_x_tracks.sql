@@ -1,4 +1,4 @@
 create table playlists_x_tracks(
-track_id text not null,
-genre_name text not null
+track_id text not null, --playlists may hold tracks that aren't saved
+genre_int_id smallint references genres(int_id) deferrable not null
 );
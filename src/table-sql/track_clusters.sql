@@ -0,0 +1,6 @@
+create table track_clusters(
+track_id text primary key references tracks(id) deferrable,
+cluster smallint not null,
+distance real, --to the cluster's centroid, in standardized feature space
+row_hash bigint --hash of the other columns, to skip unchanged rows
+);
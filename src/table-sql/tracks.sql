@@ -1,7 +1,7 @@
 create table tracks(
 id text primary key,
 name text not null,
-main_artist text references artists(id),
+main_artist text references artists(id) deferrable, --text id, like tracks.id
 available_in_us boolean not null,
 duration_ms int not null,
 explicit boolean not null,
@@ -18,5 +18,6 @@ mode boolean, --major/minor
 speechiness real,
 tempo real,
 time_signature smallint,
-valence real
+valence real,
+row_hash bigint --hash of the other columns, to skip unchanged rows
 );